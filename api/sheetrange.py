@@ -0,0 +1,64 @@
+import re
+from collections.abc import Sequence
+from typing import Optional
+
+from attr import dataclass
+
+SHEET_URL = 'https://docs.google.com/spreadsheets/d/%s'
+
+
+def sheet_url(key: str) -> str:
+    """ Link to a spreadsheet, without having to connect to it first. """
+    return SHEET_URL % key
+
+
+@dataclass(kw_only=True)
+class SheetRange:
+    """ Cells to fetch from one page, and which fields of each cell. """
+    page: int
+    cells: str      # A1 notation without the page title, e.g. 'A2:E'
+    fields: tuple = ('formattedValue',)
+
+
+class SheetRows(Sequence):
+    """
+    Rows of a fetched range, each decoded only when accessed into a tuple with one entry per column. Entries are
+    the cell's value if one field was fetched, otherwise a tuple of the fetched fields in order.
+    """
+
+    def __init__(self, row_data: list, fields: tuple, width: Optional[int] = None):
+        self._rows = row_data
+        self._fields = fields
+        self._width = width if width is not None else max((len(r.get('values', [])) for r in row_data), default=0)
+        self._empty = None if len(fields) == 1 else (None,) * len(fields)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        values = self._rows[i].get('values', [])[:self._width]
+        if len(self._fields) == 1:
+            field = self._fields[0]
+            cells = tuple(v.get(field) for v in values)
+        else:
+            cells = tuple(tuple(v.get(f) for f in self._fields) for v in values)
+        return cells + (self._empty,) * (self._width - len(cells))
+
+
+def parse_a1(cells: str) -> tuple[int, int, Optional[int]]:
+    """ Zero-based start row and column of an A1 range, and its width in columns if it has an end column. """
+    start, _, end = cells.partition(':')
+    start_col, start_row = re.fullmatch(r'([A-Z]*)(\d*)', start.upper()).groups()
+    end_col = re.fullmatch(r'([A-Z]*)(\d*)', end.upper()).group(1) if end else start_col
+    col = _column_index(start_col) if start_col else 0
+    width = _column_index(end_col) - col + 1 if end_col else None
+    return (int(start_row) - 1 if start_row else 0), col, width
+
+
+def _column_index(letters: str) -> int:
+    n = 0
+    for c in letters:
+        n = n * 26 + ord(c) - ord('A') + 1
+    return n - 1
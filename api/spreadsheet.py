@@ -4,8 +4,11 @@ import gspread
 from attr import dataclass
 from oauth2client.service_account import ServiceAccountCredentials
 
+from api.sheetrange import SheetRange, SheetRows, sheet_url, parse_a1
+
 
 BASE_URL = 'https://sheets.googleapis.com/v4/spreadsheets'
+DRIVE_URL = 'https://www.googleapis.com/drive/v3/files'
 REQ_FIELDS = 'sheets(data(rowData(values(formattedValue,hyperlink))))'
 SCOPES = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
 
@@ -35,7 +38,35 @@ class Spreadsheet(gspread.Spreadsheet):
 
     @property
     def public_url(self) -> str:
-        return self.url
+        return sheet_url(self.id)
+
+    def revision(self) -> str:
+        """ Drive version and modified time of the spreadsheet, which change whenever any cell does. """
+        res = self.client.request('get', f'{DRIVE_URL}/{self.sheet_id}',
+                                  params={'fields': 'version,modifiedTime', 'supportsAllDrives': 'true'})
+        data = res.json()
+        return f'{data.get("version")}/{data.get("modifiedTime")}'
+
+    def get_ranges(self, ranges: list[SheetRange]) -> list['SheetRows']:
+        """ Fetches only the given ranges and fields in a single request, returning the rows of each range. """
+        fields = sorted({f for r in ranges for f in r.fields})
+        params = {
+            'ranges': [f"'{self.pages[r.page].title}'!{r.cells}" for r in ranges],
+            'fields': f'sheets(properties(index),data(startRow,startColumn,rowData(values({",".join(fields)}))))',
+        }
+        data = self.fetch_sheet_metadata(params=params)
+
+        # Ranges come back grouped by page, each tagged with where it starts
+        grids = {}
+        for sheet in data.get('sheets', []):
+            page = sheet.get('properties', {}).get('index', 0)
+            for grid in sheet.get('data', []):
+                grids[(page, grid.get('startRow', 0), grid.get('startColumn', 0))] = grid.get('rowData', [])
+        out = []
+        for r in ranges:
+            start_row, start_col, width = parse_a1(r.cells)
+            out.append(SheetRows(grids.get((r.page, start_row, start_col), []), r.fields, width))
+        return out
 
     def get_all(self) -> dict:
         return self.fetch_sheet_metadata(params={'fields': REQ_FIELDS})
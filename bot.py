@@ -2,31 +2,56 @@ import asyncio
 import os
 import random
 import shutil
+from collections import OrderedDict
 from datetime import datetime
 from glob import glob
+from io import BytesIO
 
 import discord
+from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
 
-from api import chadsoft
-from api.dropbox_client import Dropbox
-from api.spreadsheet import Spreadsheet
-from utils import szsreader, kmpreader, gcpfinder
-from core import paths, cpinfo, command_utils
+from api.sheetrange import sheet_url
+from utils import gcpfinder
+from utils.lazyimport import lazy_import, warm_up
+from core import paths, command_utils, snapshot, jobs
+from core.kmpcache import KMPCache
+from core.trackwatcher import TrackWatcher
 from core.tracklists import FilesystemTrackList, SpreadsheetTrackList
 
 EMBED_COLOR = 0xCA00FF
 
+# Slow to import and only needed by some commands, so imported on first use or in the background after connecting
+chadsoft = lazy_import('api.chadsoft')
+dropbox_client = lazy_import('api.dropbox_client')
+spreadsheet_api = lazy_import('api.spreadsheet')
+batchscan = lazy_import('core.batchscan')
+LAZY_MODULES = (spreadsheet_api, chadsoft, batchscan, dropbox_client)
+
 load_dotenv()
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 SHEET_ID = os.getenv('SHEET_ID')
 GUILD_ID = os.getenv('GUILD_ID')
-
-fs_tracks = FilesystemTrackList(paths.CTGP)
-
-spreadsheet = Spreadsheet(SHEET_ID, './token.json')
-sheet_tracks = SpreadsheetTrackList(spreadsheet)
+JOB_WORKERS = os.getenv('JOB_WORKERS')
+JOB_TIMEOUT = os.getenv('JOB_TIMEOUT')
+
+SHEET_URL = sheet_url(SHEET_ID)
+SHEET_RETRY = 60    # Seconds between attempts to connect to the spreadsheet
+
+# Set up by main, since job workers import this module as well and shouldn't load any tracks
+fs_tracks: FilesystemTrackList = None
+sheet_tracks: SpreadsheetTrackList = None
+kmp_cache: KMPCache = None
+fs_watcher: TrackWatcher = None
+job_pool: jobs.JobPool = None
+spreadsheet = None
+track_updater = None
+import_warmer = None
+
+# Latest GCP results of each user's uploads by filename, so re-uploads of an edited track only re-solve what changed
+gcp_baselines: OrderedDict[tuple[int, str], gcpfinder.GCPBaseline] = OrderedDict()
+GCP_BASELINE_LIMIT = 64
 
 bot = commands.Bot(
     command_prefix='\\',
@@ -35,8 +60,46 @@ bot = commands.Bot(
 )
 
 
+def warm_kmp_cache(tracks):
+    """ Parses changed tracks' KMPs ahead of the next command that needs them. """
+    for track in tracks:
+        try:
+            kmp_cache.graph(track)
+        except OSError:     # course.kmp not there (yet)
+            pass
+
+
+async def update_tracks():
+    """ Brings the snapshot's track lists up to date, saves a new snapshot, then keeps checking the spreadsheet. """
+    global spreadsheet
+    try:
+        await asyncio.to_thread(fs_tracks.refresh)
+    except OSError as err:     # The track watcher picks it up once the folder is back
+        print(f'Track folder refresh failed: {err}')
+    # Started right away, so the sheet keeps being checked even if the first download below never succeeds
+    auto_refresh = asyncio.create_task(sheet_tracks.auto_refresh())
+    while True:
+        try:
+            if spreadsheet is None:
+                spreadsheet = await asyncio.to_thread(lambda: spreadsheet_api.Spreadsheet(SHEET_ID, './token.json'))
+            await asyncio.to_thread(sheet_tracks.connect, spreadsheet)
+            await asyncio.to_thread(snapshot.save, paths.SNAPSHOT, fs_tracks, sheet_tracks)
+            break
+        except Exception as err:
+            print(f'Spreadsheet update failed: {err}')
+            await asyncio.sleep(SHEET_RETRY)
+    print(f'Track data up to date: {datetime.now().strftime("%m/%d/%Y %H:%M:%S")}')
+    await auto_refresh
+
+
 @bot.event
 async def on_ready():
+    global track_updater, import_warmer
+    fs_watcher.start()
+    if track_updater is None:
+        track_updater = asyncio.create_task(update_tracks())
+    if import_warmer is None:
+        import_warmer = asyncio.create_task(asyncio.to_thread(warm_up, *LAZY_MODULES))
     if GUILD_ID is not None:
         # Only respond to commands in specified server
         for cmd in bot.commands:
@@ -74,7 +137,7 @@ async def cmd_links(ctx):
     """ \\links - Get important CT resources """
     desc = (
         'CTGP Ultras Spreadsheet:\n'
-        f'{spreadsheet.public_url}\n\n'
+        f'{SHEET_URL}\n\n'
         'CTGP Tockdom Page:\n'
         'http://wiki.tockdom.com/wiki/CTGPR\n\n'
         'CTGP Track Files Dropbox:\n'
@@ -95,7 +158,7 @@ async def cmd_links(ctx):
 @bot.command(name='spreadsheet', aliases=['sheet', 'sheetlink'])
 async def cmd_spreadsheet(ctx):
     """ \\spreadsheet - Get link to CTGP ultras spreadsheet """
-    await ctx.send(spreadsheet.public_url)
+    await ctx.send(SHEET_URL)
 
 
 @bot.command(name='info')
@@ -181,7 +244,7 @@ async def cmd_bkt(ctx: commands.Context, *args):
         else:
             track_args.append(a)
 
-    fsdata = fs_tracks.search(' '.join(args))
+    fsdata = fs_tracks.search(' '.join(track_args))
     if fsdata is None:
         return await ctx.send('Track name not recognized.')
 
@@ -208,27 +271,25 @@ async def cmd_szs(ctx: commands.Context, *args):
 async def cmd_kmp(ctx: commands.Context, *args):
     """ \\kmp <trackname OR szs file> - Download track\'s kmp and kcl files """
     if ctx.message.attachments:  # File input
-        filepath = await command_utils.save_to_temp(ctx.message.attachments[0])
-        if not str(filepath).endswith('.szs'):
+        attachment = ctx.message.attachments[0]
+        if not attachment.filename.endswith('.szs'):
             return await ctx.send('Invalid file type (expected .szs)')
-        else:
-            szsreader.extract_file_to(filepath, paths.TEMP / 'course.kmp', 'course.kmp')
-            szsreader.extract_file_to(filepath, paths.TEMP / 'course.kcl', 'course.kcl')
+        names = ['course.kmp', 'course.kcl']
+        data = await job_pool.run(jobs.szs_files, await attachment.read(), names)
         trackname = 'Attached Track'
-        trackdir = paths.TEMP
+        files = [discord.File(BytesIO(d), filename=name) for d, name in zip(data, names)]
     elif args:  # Text input
         fsdata = fs_tracks.search(' '.join(args))
         if fsdata is None:
             return await ctx.send('Track name not recognized.')
         trackname = fsdata.name
-        trackdir = fsdata.dir
+        files = [
+            discord.File(fsdata.dir / 'course.kmp'),
+            discord.File(fsdata.dir / 'course.kcl'),
+        ]
     else:
         raise command_utils.EmptyInputError()
 
-    files = [
-        discord.File(trackdir / 'course.kmp'),
-        discord.File(trackdir / 'course.kcl'),
-    ]
     await ctx.send(f'**{trackname}**', files=files)
 
 
@@ -255,26 +316,19 @@ async def cmd_cpinfo(ctx: commands.Context, *args):
     """ \\cpinfo <trackname OR szs/kmp file> - Get stats for track\'s checkpoint map """
     if ctx.message.attachments:  # File input
         trackname = 'Attached Track'
-        filepath = await command_utils.save_to_temp(ctx.message.attachments[0])
-        if str(filepath).endswith('.kmp'):
-            kmp_path = filepath
-        elif str(filepath).endswith('.szs'):
-            kmp_path = paths.TEMP / 'course.kmp'
-            szsreader.extract_file_to(filepath, kmp_path, 'course.kmp')
-        else:
+        attachment = ctx.message.attachments[0]
+        cpdata = await job_pool.run(jobs.upload_cpinfo, attachment.filename, await attachment.read())
+        if cpdata is None:
             return await ctx.send('Invalid file type (expected .szs or .kmp)')
     elif args:  # Text input
         fsdata = fs_tracks.search(' '.join(args))
         if fsdata is None:
             return await ctx.send('Track name not recognized.')
         trackname = fsdata.name
-        kmp_path = fsdata.dir / 'course.kmp'
+        cpdata = await job_pool.run(kmp_cache.cpinfo, fsdata)
     else:
         raise command_utils.EmptyInputError()
 
-    with open(kmp_path, 'rb') as f:
-        cpdata = cpinfo.calculate_cpinfo(kmpreader.parse(f), trackname, silent=True)
-
     if cpdata.from_cp0 == '-1':
         await ctx.send('Checkpoint info unavailable for this track (multiple finish lines).')
         return
@@ -298,12 +352,14 @@ async def cmd_cpinfo(ctx: commands.Context, *args):
 @bot.command(name='gcps')
 @command_utils.help_msg
 async def cmd_gcps(ctx: commands.Context, *args):
-    """ \\gcps [option] <trackname OR szs/kmp file> - Generates Desmos graph of the full track. """
+    """ \\gcps [option] <trackname OR szs/kmp file [trackname]> - Generates Desmos graph of the full track. """
     args = [a.lower() for a in args]
     track_args = []
     splitpaths = False
     noquads = False
     dev = False
+    symbolic = False
+    compression = None
 
     # Parse command
     for a in args:
@@ -313,46 +369,77 @@ async def cmd_gcps(ctx: commands.Context, *args):
             noquads = True
         elif a == 'dev':
             dev = True
+        elif a in ('symbolic', 'sym'):
+            symbolic = True
+        elif a == 'zip':
+            compression = 'zip'
+        elif a in ('gzip', 'gz'):
+            compression = 'gzip'
         else:
             track_args.append(a)
 
+    baseline = None
     if ctx.message.attachments:  # File input
         trackname = 'Attached Track'
-        filepath = await command_utils.save_to_temp(ctx.message.attachments[0])
-        if str(filepath).endswith('.kmp'):
-            kmp_path = filepath
-        elif str(filepath).endswith('.szs'):
-            kmp_path = paths.TEMP / 'course.kmp'
-            szsreader.extract_file_to(filepath, kmp_path, 'course.kmp')
-        else:
+        attachment = ctx.message.attachments[0]
+        if not attachment.filename.endswith(('.szs', '.kmp')):
             return await ctx.send('Invalid file type (expected .szs or .kmp)')
+        kmp_data = await attachment.read()
+        upload_key = (ctx.author.id, attachment.filename)
+        if track_args:  # Compare against a stored track
+            fsdata = fs_tracks.search(' '.join(track_args))
+            if fsdata is None:
+                return await ctx.send('Track name not recognized.')
+            baseline = await job_pool.run(kmp_cache.baseline, fsdata, jobs.GCP_BOUNDS)
+        else:  # Compare against this user's last upload of the same file
+            baseline = gcp_baselines.get(upload_key)
     elif track_args:  # Text input
         fsdata = fs_tracks.search(' '.join(track_args))
         if fsdata is None:
             return await ctx.send('Track name not recognized.')
         trackname = fsdata.name
-        kmp_path = fsdata.dir / 'course.kmp'
+        kmp_data = None
     else:
         raise command_utils.EmptyInputError()
 
-    with open(kmp_path, 'rb') as f:
-        rawkmp = kmpreader.parse(f)
-
-    gcplist = gcpfinder.find(rawkmp, bounds=(-500000, 500000))
-    html = gcpfinder.graph(rawkmp, gcplist, splitpaths, (not noquads), dev, bounds=(-500000, 500000))
-
-    paths.clear_temp()
-    gcp_path = paths.TEMP / f'{trackname}.desmos.html'
-    with open(gcp_path, 'w') as out:
-        out.write(html)
-
-    if len(gcplist) > 0:
-        gcpfound = 'Ghost checkpoints found at: ' + ', '.join([str(g) for g in gcplist])
-    else:
-        gcpfound = 'No ghost checkpoints found.'
-
-    msg = f'**{trackname}**\n{gcpfound}\nDownload file and open in browser:'
-    await ctx.send(content=msg, file=discord.File(gcp_path))
+    # Each command writes to its own folder, since other jobs may be writing theirs at the same time
+    temp_dir = paths.TEMP / str(ctx.message.id)
+    os.makedirs(temp_dir, exist_ok=True)
+    out_path = temp_dir / f'{trackname}.desmos.html'
+    graph = dict(splitpaths=splitpaths, fillquads=(not noquads), dev=dev, numeric=(not symbolic))
+    size_limit = ctx.guild.filesize_limit if ctx.guild else 25 * 1024 * 1024
+    try:
+        if kmp_data is None:
+            gcp_path, gcplist = await job_pool.run(
+                jobs.track_gcps, kmp_cache, fsdata, out_path, graph, compression, size_limit)
+        else:
+            result = await job_pool.run(
+                jobs.upload_gcps, attachment.filename, kmp_data, baseline, out_path, graph, compression, size_limit)
+            if result is None:
+                return await ctx.send('Invalid file type (expected .szs or .kmp)')
+            gcp_path, update = result
+            gcplist = update.gcps
+            gcp_baselines[upload_key] = update.baseline
+            gcp_baselines.move_to_end(upload_key)
+            if len(gcp_baselines) > GCP_BASELINE_LIMIT:
+                gcp_baselines.popitem(last=False)
+
+        if len(gcplist) > 0:
+            gcpfound = 'Ghost checkpoints found at: ' + ', '.join([str(g) for g in gcplist])
+        else:
+            gcpfound = 'No ghost checkpoints found.'
+        if baseline is not None:
+            appeared = ', '.join(str(g) for g in update.appeared) or 'none'
+            disappeared = ', '.join(str(g) for g in update.disappeared) or 'none'
+            gcpfound += f'\nSince last version: new GCPs at {appeared}, removed GCPs at {disappeared}'
+
+        if gcp_path.suffix == '.html':
+            msg = f'**{trackname}**\n{gcpfound}\nDownload file and open in browser:'
+        else:
+            msg = f'**{trackname}**\n{gcpfound}\nDownload and extract file, then open in browser:'
+        await ctx.send(content=msg, file=discord.File(gcp_path))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 
 @bot.command(name='random')
@@ -362,6 +449,75 @@ async def random_track(ctx: commands.Context):
     await cmd_info(ctx, trackname)
 
 
+# APP COMMANDS #########################################################################################################
+
+
+def in_guild(interaction: discord.Interaction) -> bool:
+    """ Same as the GUILD_ID check on prefix commands, which the slash commands skip by calling them directly. """
+    return GUILD_ID is None or (interaction.guild is not None and str(interaction.guild.id) == GUILD_ID)
+
+
+@bot.tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    if not isinstance(error, app_commands.CheckFailure):
+        await app_commands.CommandTree.on_error(bot.tree, interaction, error)
+
+
+async def track_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+    return [app_commands.Choice(name=name, value=name) for name in fs_tracks.complete(current)]
+
+
+@bot.tree.command(name='info', description='Get general track information')
+@app_commands.check(in_guild)
+@app_commands.autocomplete(track=track_autocomplete)
+async def slash_info(interaction: discord.Interaction, track: str):
+    ctx = await commands.Context.from_interaction(interaction)
+    await cmd_info(ctx, track)
+
+
+@bot.tree.command(name='bkt', description='Get link to track\'s best known time')
+@app_commands.check(in_guild)
+@app_commands.autocomplete(track=track_autocomplete)
+@app_commands.choices(category=[
+    app_commands.Choice(name='Normal', value='normal'),
+    app_commands.Choice(name='Glitch', value='glitch'),
+    app_commands.Choice(name='No shortcut', value='no-sc'),
+])
+@app_commands.rename(cc200='200cc')
+async def slash_bkt(interaction: discord.Interaction, track: str, category: str = 'normal', flap: bool = False,
+                    cc200: bool = False):
+    ctx = await commands.Context.from_interaction(interaction)
+    options = [category] if category != 'normal' else []
+    options += ['flap'] if flap else []
+    options += ['200cc'] if cc200 else []
+    await cmd_bkt(ctx, track, *options)
+
+
+@bot.tree.command(name='cpinfo', description='Get stats for track\'s checkpoint map')
+@app_commands.check(in_guild)
+@app_commands.autocomplete(track=track_autocomplete)
+async def slash_cpinfo(interaction: discord.Interaction, track: str = None, file: discord.Attachment = None):
+    ctx = await commands.Context.from_interaction(interaction)     # Attachment options become message attachments
+    await cmd_cpinfo(ctx, *([track] if track else []))
+
+
+@bot.tree.command(name='gcps', description='Generate Desmos graph of the full track')
+@app_commands.check(in_guild)
+@app_commands.autocomplete(track=track_autocomplete)
+@app_commands.choices(compression=[
+    app_commands.Choice(name='zip', value='zip'),
+    app_commands.Choice(name='gzip', value='gzip'),
+])
+async def slash_gcps(interaction: discord.Interaction, track: str = None, file: discord.Attachment = None,
+                     split_paths: bool = False, no_fill: bool = False, symbolic: bool = False, compression: str = ''):
+    ctx = await commands.Context.from_interaction(interaction)
+    options = ['split-paths'] if split_paths else []
+    options += ['no-fill'] if no_fill else []
+    options += ['symbolic'] if symbolic else []
+    options += [compression] if compression else []
+    await cmd_gcps(ctx, *([track] if track else []), *options)
+
+
 # OWNER COMMANDS #######################################################################################################
 
 
@@ -369,7 +525,11 @@ async def random_track(ctx: commands.Context):
 @commands.is_owner()
 async def cmd_sync(ctx: commands.Context):
     msg = await ctx.send('Syncing...')
-    synced = await bot.tree.sync(guild=ctx.guild)
+    if ctx.guild is None:   # No guild to copy to in DMs, so sync globally instead
+        synced = await bot.tree.sync()
+    else:
+        bot.tree.copy_global_to(guild=ctx.guild)
+        synced = await bot.tree.sync(guild=ctx.guild)
     await msg.edit(content=f'Synced {len(synced)} app commands.')
 
 
@@ -395,13 +555,37 @@ async def cmd_sheet_tracks(ctx: commands.Context):
     )
 
 
+@bot.command(name='search-stats')
+@commands.is_owner()
+async def cmd_search_stats(ctx: commands.Context):
+    await ctx.send(
+        f'Filesystem tracks: {fs_tracks.cache_info()}\n'
+        f'Spreadsheet tracks: {sheet_tracks.cache_info()}'
+    )
+
+
 @bot.command(name='refresh-tracks')
 @commands.is_owner()
-async def cmd_refresh_tracks(ctx: commands.Context):
+async def cmd_refresh_tracks(ctx: commands.Context, force: str = None):
     msg = await ctx.send('Refreshing track data...')
-    fs_tracks.refresh()
-    sheet_tracks.refresh()
-    await msg.edit(content='Successfully refreshed track data.')
+    await asyncio.to_thread(fs_tracks.refresh)
+    downloaded = await sheet_tracks.refresh_async(force == 'force')
+    await asyncio.to_thread(snapshot.save, paths.SNAPSHOT, fs_tracks, sheet_tracks)
+    sheet_status = 'downloaded' if downloaded else 'unchanged'
+    await msg.edit(content=f'Successfully refreshed track data (spreadsheet {sheet_status}).')
+
+
+@bot.command(name='scan-gcps')
+@commands.is_owner()
+async def cmd_scan_gcps(ctx: commands.Context):
+    report_path = paths.MAIN / 'gcp_scan.csv'
+    msg = await ctx.send('Scanning all tracks for ghost checkpoints (this will take a while)...')
+    # Runs through the job pool, since a pool of its own would fork from the bot's threads and add to its CPU use
+    count = await batchscan.scan_jobs(fs_tracks.tracks(), report_path, job_pool)
+    if os.path.isfile(report_path):
+        await msg.reply(f'Scanned {count} new or changed tracks.', file=discord.File(report_path))
+    else:   # No tracks, so no report either
+        await msg.reply(f'Scanned {count} new or changed tracks.')
 
 
 @bot.command(name='download-dropbox')
@@ -412,15 +596,37 @@ async def cmd_download_dropbox(ctx: commands.Context, token: str):
         # Testing locally
         target_path = target_path / '_TEST_DIR'
     msg = await ctx.send('Downloading tracks from dropbox (this will take a while)...')
-    dropbox = Dropbox(token)
+    dropbox = dropbox_client.Dropbox(token)
     shutil.rmtree(target_path)
 
     await asyncio.to_thread(dropbox.download_folder_to, target_path, '/CTGP Custom Tracks')
 
     await msg.reply('Successfully downloaded track folders from dropbox')
-    fs_tracks.refresh()
+    await asyncio.to_thread(fs_tracks.refresh)
     await msg.reply('Successfully refreshed track files.')
 
 
-if __name__ == '__main__':
+def main():
+    global fs_tracks, sheet_tracks, kmp_cache, fs_watcher, job_pool
+    # Start from the last snapshot of the track lists, and only connect to the spreadsheet once the bot is up
+    fs_tracks = FilesystemTrackList(paths.CTGP, refresh=False)
+    sheet_tracks = SpreadsheetTrackList(None, refresh=False)
+    fs_restored, _ = snapshot.load(paths.SNAPSHOT, fs_tracks, sheet_tracks)
+    if not fs_restored:
+        fs_tracks.refresh()
+
+    kmp_cache = KMPCache(paths.CACHE)
+    fs_watcher = TrackWatcher(fs_tracks, paths.CTGP)
+    fs_watcher.add_listener(warm_kmp_cache)
+
+    # KMP parsing, GCP solving, graph generation and SZS decompression run here instead of on the event loop
+    job_pool = jobs.JobPool(
+        workers=int(JOB_WORKERS) if JOB_WORKERS else None,
+        timeout=float(JOB_TIMEOUT) if JOB_TIMEOUT else jobs.JOB_TIMEOUT,
+    )
+    job_pool.start()
     bot.run(DISCORD_TOKEN)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import os
+import csv
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import attr
+
+from core.cpinfo import CheckpointData, calculate_cpinfo
+from utils import kmpreader, gcpfinder
+from utils.cpgraph import CheckpointGraph
+
+GCP_BOUNDS = (-500000, 500000)
+FIELDS = ['name', 'sha1', 'gcps'] + [f.name for f in attr.fields(CheckpointData)] + ['seconds']
+
+
+def scan(tracks, report_path: os.PathLike, workers: int = None, log=print) -> int:
+    """
+    Finds GCPs and checkpoint info for every track across a process pool, appending one CSV row per track to
+    report_path as results come in. Tracks already in the report with the same SHA1 are skipped, so an interrupted
+    scan can be resumed by running it again. Returns the number of tracks scanned.
+
+    Starts a pool of its own, so this is meant for running from the command line and not from inside the bot.
+
+    :param tracks: Iterable of FilesystemTrack
+    """
+    todo = _todo(tracks, report_path)
+    if not todo:
+        return 0
+
+    with _Report(report_path, len(todo), log) as report, ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(_scan_track, *_scan_args(t)): t for t in todo}
+        for future in as_completed(futures):
+            try:
+                report.add(futures[future], future.result())
+            except Exception as err:
+                report.failed(futures[future], err)
+    return len(todo)
+
+
+async def scan_jobs(tracks, report_path: os.PathLike, job_pool, log=print) -> int:
+    """
+    Same as scan, but runs each track as a job on an already started JobPool. Only one track per worker is submitted
+    at a time, so other commands can still be queued while the scan runs.
+    """
+    todo = _todo(tracks, report_path)
+    if not todo:
+        return 0
+    slots = asyncio.Semaphore(job_pool.workers)
+
+    async def scan_track(track):
+        async with slots:
+            try:
+                return track, await job_pool.run(_scan_track, *_scan_args(track)), None
+            except Exception as err:
+                return track, None, err
+
+    with _Report(report_path, len(todo), log) as report:
+        for next_result in asyncio.as_completed([scan_track(t) for t in todo]):
+            track, row, err = await next_result
+            if err is None:
+                report.add(track, row)
+            else:
+                report.failed(track, err)
+    return len(todo)
+
+
+class _Report:
+    """ Appends scanned tracks to the CSV report one row at a time, so nothing is lost if the scan is stopped. """
+
+    def __init__(self, report_path: os.PathLike, total: int, log):
+        new_file = not os.path.isfile(report_path) or os.path.getsize(report_path) == 0
+        self._file = open(report_path, 'a', newline='')
+        self._writer = csv.DictWriter(self._file, FIELDS)
+        if new_file:
+            self._writer.writeheader()
+        self._total = total
+        self._count = 0
+        self._log = log
+
+    def add(self, track, row: dict):
+        self._writer.writerow(row)
+        self._file.flush()
+        self._count += 1
+        self._log(f'[{self._count}/{self._total}] {track.name}: {row["seconds"]:.2f}s')
+
+    def failed(self, track, err: Exception):
+        self._count += 1
+        self._log(f'[{self._count}/{self._total}] {track.name}: failed ({err})')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._file.close()
+
+
+def _todo(tracks, report_path: os.PathLike) -> list:
+    done = _finished(report_path)
+    return [t for t in tracks if done.get(t.name) != t.sha1]
+
+
+def _scan_args(track) -> tuple[str, str, str]:
+    return track.name, track.sha1, str(track.dir / 'course.kmp')
+
+
+def _scan_track(name: str, sha1: str, kmp_path: str) -> dict:
+    start = time.perf_counter()
+    with open(kmp_path, 'rb') as f:
+        cpgraph = CheckpointGraph(kmpreader.parse(f, engine='numpy', lazy=True))
+    gcps = gcpfinder.find(cpgraph, bounds=GCP_BOUNDS, engine='clip')
+    cpdata = calculate_cpinfo(cpgraph, name, silent=True)
+    return {
+        'name': name,
+        'sha1': sha1,
+        'gcps': ' '.join(str(g) for g in gcps),
+        **attr.asdict(cpdata),
+        'seconds': round(time.perf_counter() - start, 4),
+    }
+
+
+def _finished(report_path: os.PathLike) -> dict:
+    """ Maps each track name already in the report to its SHA1. """
+    if not os.path.isfile(report_path):
+        return {}
+    with open(report_path, 'r', newline='') as f:
+        return {row['name']: row['sha1'] for row in csv.DictReader(f)}
+
+
+if __name__ == '__main__':
+    import sys
+    from core import paths
+    from core.tracklists import FilesystemTrackList
+
+    # Usage: python -m core.batchscan [report.csv] [workers]
+    out = sys.argv[1] if len(sys.argv) > 1 else paths.MAIN / 'gcp_scan.csv'
+    nworkers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    fs_tracks = FilesystemTrackList(paths.CTGP)
+    total = time.perf_counter()
+    count = scan(fs_tracks.tracks(), out, nworkers)
+    print(f'Scanned {count} tracks in {time.perf_counter() - total:.2f}s, report at {out}')
@@ -1,5 +1,9 @@
+import attr
+import numpy
 from attr import dataclass
 
+from utils.cpgraph import checkpoint_graph
+
 
 @dataclass
 class CheckpointData:
@@ -14,93 +18,113 @@ class CheckpointData:
     anomalies: str = None
 
 
+# Structured array layout of CheckpointData, one record per track
+CPINFO_DTYPE = numpy.dtype([
+    (f.name, {int: numpy.int32, float: numpy.float64}.get(f.type, object)) for f in attr.fields(CheckpointData)
+])
+
+
 def calculate_cpinfo(kmpobj, trackname='track', silent=False) -> CheckpointData:
+    """
+    :param kmpobj: Parsed KMP or a CheckpointGraph already built from one
+    """
     if not silent:
         print(f'Calculating values for {trackname}...')
-    ckpt: list[dict] = kmpobj['CKPT']['entries']     # [c['type'] for c in kmp['CKPT']['entries']]
-    ckph: list[dict] = kmpobj['CKPH']['entries']
-    values = [len(ckph), len(ckpt)]
+    return CheckpointData(*_cpinfo_values(checkpoint_graph(kmpobj)))
 
-    # Map each checkpoint to its group
-    group = {}
-    for g in ckph:
-        for i in range(g['start'], g['start'] + g['len']):
-            group[i] = g
 
-    # Find important checkpoints
-    cp0count:       int = 0
-    kcpcount:       int = 0
-    total_layers:   int = 0
-    kcp0:           int = 0
-    cp1s:           list[int] = []
-    lastcps:        list[int] = []
-    maxkcps:        list[int] = [0]
-    for cp in ckpt:
-        if cp['type'] < 255:
-            kcpcount += 1
-
-            if cp['type'] == 0:     # Find kcp0 and checkpoint(s) immediately following
-                kcp0 = cp['idx']
-                cp0count += 1
-                if cp['next'] == 255:
-                    for i in [j for j in group[kcp0]['next'] if j < 255]:
-                        cp1s += [ckph[i]['start']]
-                else:
-                    cp1s = [cp['next']]
-
-                for i in [j for j in group[kcp0]['prev'] if j < 255]:       # Find cp behind kcp0
-                    lastcps += [ckph[i]['start'] + ckph[i]['len'] - 1]
-                    if total_layers < ckph[i]['layer']:
-                        total_layers = ckph[i]['layer']
-
-            kcp = ckpt[maxkcps[0]]
-            if kcp['type'] < cp['type'] < 100:   # Find max key checkpoint(s)
-                maxkcps = [cp['idx']]
-            elif kcp['type'] == cp['type']:
-                maxkcps += [cp['idx']]
-
-    values.append(kcpcount)
-    values.append(maxkcps[0])
-
-    if cp0count != 1:
-        values += [-1, -1, -1, -1]
-        return CheckpointData(*values)
-
-    # Calculate lap completion for each checkpoint
-    completion = {}
-    for i in range(len(ckpt)):
-        group_c = (i - group[i]['start']) / group[i]['len']
-        overall_c = (group_c + group[i]['layer'] - 1) / total_layers
-        completion[i] = overall_c
-
-    cp1: int = cp1s[0]
-    for cp in cp1s:
-        if completion[cp1] < completion[cp]:
-            cp1 = cp
-
-    lastcp: int = lastcps[0]
-
-    maxkcp: int = maxkcps[0]
-    for kcp in maxkcps:
-        if completion[maxkcp] > completion[kcp]:
-            maxkcp = kcp
+def calculate_cpinfo_batch(kmpobjs) -> numpy.ndarray:
+    """
+    Calculates checkpoint data for many tracks at once.
 
-    # Calculate maximum indices that avoid 95% from cp0 and cp1
-    ifrom0 = 0
-    ifrom1 = 0
-    for i in range(lastcp, 0, -1):
-        interval = 1 / (group[i]['len'] * total_layers)
+    :param kmpobjs: Iterable of parsed KMPs or CheckpointGraphs
+    :return: Structured array with a CPINFO_DTYPE record per track
+    """
+    rows = [_cpinfo_values(checkpoint_graph(k)) + (None,) for k in kmpobjs]
+    return numpy.array(rows, CPINFO_DTYPE)
 
-        if ifrom1 == 0 and completion[i] <= 0.95 + completion[cp1]:
-            ifrom1 = i + ((0.95 + completion[cp1] - completion[i]) / interval)
 
-        if ifrom0 == 0 and completion[i] <= 0.95 + completion[kcp0]:
-            ifrom0 = i + ((0.95 + completion[kcp0] - completion[i]) / interval)
-            break
+def _cpinfo_values(cpg) -> tuple:
+    types = cpg.type
+    counts = (cpg.group_count, cpg.cp_count)
 
-    values.append(float('{:.2f}'.format(min(ifrom0, lastcp))))
-    values.append(float('{:.2f}'.format(min(ifrom1, lastcp))))
-    values.append(float('{:.4f}'.format(completion[maxkcp])))
-    values.append(float('{:.4f}'.format(min(0.95 + completion[cp1], completion[lastcp]))))
+    # Find important checkpoints
+    is_kcp = types < 255
+    kcp0s = numpy.flatnonzero(types == 0)
+    maxkcps = _max_kcps(types, is_kcp)
+    values = counts + (int(is_kcp.sum()), int(maxkcps[0]))
+
+    if len(kcp0s) != 1 or cpg.completion is None:
+        return values + (-1, -1, -1, -1)
+
+    kcp0 = int(kcp0s[0])
+    cp1s = cpg.nexts(kcp0)
+    lastcp = cpg.group_ends(cpg.group_prev[cpg.group[kcp0]])[0]     # Checkpoint behind kcp0
 
-    return CheckpointData(*values)
+    # Lap completion for each checkpoint
+    completion = cpg.completion.tolist()
+    cp1 = cp1s[int(numpy.argmax(cpg.completion[cp1s]))]
+    maxkcp = maxkcps[int(numpy.argmin(cpg.completion[maxkcps]))]
+
+    # Calculate maximum indices that avoid 95% from cp0 and cp1
+    threshold0 = 0.95 + completion[kcp0]
+    threshold1 = 0.95 + completion[cp1]
+    i0 = _last_below(cpg.completion, lastcp, threshold0)
+    i1 = _last_below(cpg.completion, lastcp, threshold1)
+    ifrom0 = _fractional_index(cpg, i0, threshold0)
+    ifrom1 = _fractional_index(cpg, i1, threshold1) if i1 >= i0 else 0    # Search stops at the cp0 threshold
+
+    return values + (
+        round(float(min(ifrom0, lastcp)), 2),
+        round(float(min(ifrom1, lastcp)), 2),
+        round(completion[maxkcp], 4),
+        round(min(0.95 + completion[cp1], completion[lastcp]), 4),
+    )
+
+
+def _max_kcps(types: numpy.ndarray, is_kcp: numpy.ndarray) -> list[int]:
+    """
+    Key checkpoints of the highest regular type above checkpoint 0's type. If there are none, checkpoint 0
+    followed by every key checkpoint of its type.
+    """
+    if len(types) == 0:
+        return [0]
+    higher = is_kcp & (types > types[0]) & (types < 100)
+    if higher.any():
+        return numpy.flatnonzero(types == types[higher].max()).tolist()
+    return [0] + numpy.flatnonzero(is_kcp & (types == types[0])).tolist()
+
+
+def _last_below(completion: numpy.ndarray, lastcp: int, threshold: float) -> int:
+    """ Last checkpoint in 1..lastcp with completion at or below the threshold, or 0 if there is none. """
+    # Completion isn't monotonic across branches, but its suffix minimum is, and the last index where the
+    # suffix minimum is at or below the threshold is the last checkpoint that is
+    suffix_min = numpy.minimum.accumulate(completion[lastcp:0:-1])[::-1]
+    return int(numpy.searchsorted(suffix_min, threshold, side='right'))
+
+
+def _fractional_index(cpg, i: int, threshold: float) -> float:
+    """ Fractional index past checkpoint i where completion reaches the threshold. """
+    if i == 0:
+        return 0
+    interval = 1 / (int(cpg.group_len[cpg.group[i]]) * cpg.total_layers)
+    return i + (threshold - float(cpg.completion[i])) / interval
+
+
+if __name__ == '__main__':
+    # Library-wide checkpoint statistics from the cached checkpoint graphs
+    import time
+    from core import paths
+    from core.kmpcache import KMPCache
+    from core.tracklists import FilesystemTrackList
+
+    cache = KMPCache(paths.CACHE)
+    graphs = [cache.graph(t) for t in FilesystemTrackList(paths.CTGP).tracks()]
+    start = time.perf_counter()
+    data = calculate_cpinfo_batch(graphs)
+    elapsed = time.perf_counter() - start
+    valid = data[data['from_cp0'] >= 0]
+    print(f'{len(data)} tracks in {elapsed * 1000:.2f}ms, {len(valid)} with lap completion')
+    if len(valid):
+        print(f'Mean checkpoints: {data["cp_count"].mean():.1f}, key checkpoints: {data["kcp_count"].mean():.1f}')
+        print(f'Mean max ultra completion: {valid["max_ultra_p"].mean():.4f}')
@@ -0,0 +1,157 @@
+import os
+import asyncio
+import multiprocessing
+from io import BytesIO
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from core.cpinfo import CheckpointData, calculate_cpinfo
+from utils import gcpfinder
+from utils.cpgraph import CheckpointGraph
+from utils.lazyimport import lazy_import
+
+kmpreader = lazy_import('utils.kmpreader')
+szsreader = lazy_import('utils.szsreader')
+
+JOB_WORKERS = min(4, os.cpu_count() or 1)
+JOB_TIMEOUT = 120       # Seconds from submitting a job until its command gives up on it
+JOB_QUEUE_LIMIT = 8     # Jobs waiting for a free worker before new ones are turned away
+GCP_BOUNDS = (-500000, 500000)
+
+# Not fork, since replacing a crashed pool from the running bot would fork while other threads may hold locks
+JOB_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class JobError(Exception):
+    """ Raised when a job couldn't be run or didn't finish, with a message meant for the user. """
+    pass
+
+
+class JobPool:
+    """
+    Runs CPU-bound command work in a process pool, so the event loop only waits on it. Jobs count against the
+    queue until their worker actually finishes them, including ones their command already gave up on.
+    """
+
+    def __init__(self, workers: int = None, timeout: float = JOB_TIMEOUT, max_queued: int = JOB_QUEUE_LIMIT):
+        self.workers = workers or JOB_WORKERS
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._active = 0    # Submitted jobs that haven't finished, running or queued
+
+    def start(self):
+        """ Starts every worker and waits until they're up, so the first jobs don't wait on worker startup. """
+        if self._executor is None:
+            self._executor = self._new_executor()
+            # Workers are only started as jobs come in, so give each of them one
+            for future in [self._executor.submit(int) for _ in range(self.workers)]:
+                future.result(self.timeout)
+
+    @property
+    def queued(self) -> int:
+        return max(0, self._active - self.workers)
+
+    async def run(self, func, *args):
+        """ Runs func(*args) in a worker process and returns its result. func and args must be picklable. """
+        if self._active >= self.workers + self.max_queued:
+            raise JobError('The bot is busy with other requests right now, please try again in a minute.')
+        if self._executor is None:    # After a crash, or if start wasn't called
+            self._executor = self._new_executor()
+
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(func, *args)
+        self._active += 1
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._finished))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise JobError(f'This took longer than {self.timeout:g} seconds and was cancelled.') from None
+        except BrokenProcessPool:
+            self._executor = None   # A worker died, so start over with a new pool
+            raise JobError('Something went wrong while processing this, please try again.') from None
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        context = multiprocessing.get_context(JOB_START_METHOD)
+        return ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker)
+
+    def _finished(self):
+        self._active -= 1
+
+
+def _init_worker():
+    """ Imports what jobs need up front, so a worker's first job doesn't wait on it. """
+    kmpreader.load()
+    szsreader.load()
+
+
+# JOBS #################################################################################################################
+
+
+def upload_kmp(filename: str, data: bytes) -> Optional[bytes]:
+    """
+    The KMP of an uploaded .kmp file, or course.kmp out of an uploaded .szs file. Returns None if the file type
+    isn't supported or the archive has no course.kmp.
+    """
+    if filename.endswith('.kmp'):
+        return data
+    if filename.endswith('.szs'):
+        return szsreader.extract_member(BytesIO(data), 'course.kmp')
+    return None
+
+
+def szs_files(data: bytes, names: list[str]) -> list[bytes]:
+    """ Decompresses a .szs file and copies out the given files. """
+    archive = szsreader.SZSArchive(szsreader.decompress(BytesIO(data)))
+    return [bytes(archive[name]) for name in names]
+
+
+def upload_cpinfo(filename: str, data: bytes) -> Optional[CheckpointData]:
+    """ Checkpoint data of an uploaded .kmp or .szs file, or None if it has no KMP. """
+    kmp_data = upload_kmp(filename, data)
+    if kmp_data is None:
+        return None
+    return calculate_cpinfo(kmpreader.parse(BytesIO(kmp_data), engine='numpy', lazy=True), silent=True)
+
+
+def track_gcps(cache, track, path: os.PathLike, graph: dict, compression: str, size_limit: int):
+    """
+    Finds a stored track's GCPs through the KMP cache and saves its graph.
+
+    :param graph: Keyword arguments for gcpfinder.save_graph
+    :return: Path of the saved graph, and the GCPs
+    """
+    cpgraph, gcplist = cache.graph_gcps(track, bounds=GCP_BOUNDS)
+    return _save_graph(path, cpgraph, gcplist, graph, compression, size_limit), gcplist
+
+
+def upload_gcps(filename: str, data: bytes, baseline: Optional[gcpfinder.GCPBaseline], path: os.PathLike,
+                graph: dict, compression: str, size_limit: int):
+    """
+    Finds an uploaded .kmp or .szs file's GCPs, only re-solving checkpoints that changed since the baseline, and
+    saves its graph.
+
+    :return: Path of the saved graph and the GCPUpdate, or None if the file has no KMP
+    """
+    kmp_data = upload_kmp(filename, data)
+    if kmp_data is None:
+        return None
+    cpgraph = CheckpointGraph(kmpreader.parse(BytesIO(kmp_data), engine='numpy', lazy=True))
+    update = gcpfinder.find_incremental(cpgraph, baseline, bounds=GCP_BOUNDS)
+    return _save_graph(path, cpgraph, update.gcps, graph, compression, size_limit), update
+
+
+def _save_graph(path, cpgraph, gcplist, graph: dict, compression: str, size_limit: int) -> Path:
+    gcp_path = gcpfinder.save_graph(path, cpgraph, gcplist, **graph, bounds=GCP_BOUNDS, compression=compression)
+    # Fall back to a zip if the plain HTML is too large to upload
+    if compression is None and gcp_path.stat().st_size > size_limit:
+        gcp_path.unlink()
+        gcp_path = gcpfinder.save_graph(path, cpgraph, gcplist, **graph, bounds=GCP_BOUNDS, compression='zip')
+    return gcp_path
@@ -0,0 +1,149 @@
+import os
+import json
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import attr
+import numpy
+
+from core.cpinfo import CheckpointData, calculate_cpinfo
+from utils import gcpfinder
+from utils.cpgraph import CheckpointGraph
+from utils.lazyimport import lazy_import
+
+kmpreader = lazy_import('utils.kmpreader')
+
+CACHE_VERSION = 1
+
+
+class KMPCache:
+    """
+    Persistent cache of checkpoint data for filesystem tracks, one .npz file per track.
+
+    Entries are keyed by the track's SHA1 and invalidated when its course.kmp is modified. Once the cache grows past
+    max_bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir: os.PathLike, max_bytes: int = 64 * 1024 * 1024):
+        self._dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        os.makedirs(self._dir, exist_ok=True)
+
+    def graph(self, track) -> CheckpointGraph:
+        return _graph(self._load(track))
+
+    def cpinfo(self, track) -> CheckpointData:
+        entry = self._load(track)
+        if 'cpinfo' not in entry:
+            cpdata = calculate_cpinfo(_graph(entry), track.name, silent=True)
+            entry['cpinfo'] = numpy.array(json.dumps(attr.asdict(cpdata)))
+            self._write(track, entry)
+        return CheckpointData(**json.loads(entry['cpinfo'].item()))
+
+    def gcps(self, track, bounds=(None, None)) -> list[int]:
+        return self._gcps(track, self._load(track), bounds)
+
+    def graph_gcps(self, track, bounds=(None, None)) -> tuple[CheckpointGraph, list[int]]:
+        """ The track's checkpoint graph and GCPs, reading its entry only once. """
+        entry = self._load(track)
+        cpgraph = _graph(entry)
+        return cpgraph, self._gcps(track, entry, bounds, cpgraph)
+
+    def baseline(self, track, bounds=(None, None)) -> gcpfinder.GCPBaseline:
+        """ GCP results of the stored KMP, to diff an edited version of the track against. """
+        cpgraph, gcplist = self.graph_gcps(track, bounds)
+        return gcpfinder.GCPBaseline.from_kmp(cpgraph, gcplist, bounds)
+
+    def clear(self):
+        for f in self._dir.glob('*.npz'):
+            os.remove(f)
+
+    def _gcps(self, track, entry: dict, bounds, cpgraph: CheckpointGraph = None) -> list[int]:
+        key = numpy.array([numpy.nan if b is None else b for b in bounds], float)
+        if 'gcps' not in entry or not numpy.array_equal(entry['gcp_bounds'], key, equal_nan=True):
+            if cpgraph is None:
+                cpgraph = _graph(entry)
+            entry['gcps'] = numpy.array(gcpfinder.find(cpgraph, bounds=bounds, engine='clip'), int)
+            entry['gcp_bounds'] = key
+            self._write(track, entry)
+        return entry['gcps'].tolist()
+
+    def _path(self, track) -> Path:
+        return self._dir / f'{track.sha1}.npz'
+
+    def _load(self, track) -> dict:
+        """ Returns the track's entry, re-parsing its KMP if the cached copy is missing or stale. """
+        entry = self._read(track)
+        if entry is None:
+            with open(track.dir / 'course.kmp', 'rb') as f:
+                kmp = kmpreader.parse(f, engine='numpy', lazy=True)
+            entry = {
+                'version': numpy.array(CACHE_VERSION),
+                'mtime': numpy.array(_mtime(track)),
+                'CKPT': kmp['CKPT']['entries'],
+                'CKPH': kmp['CKPH']['entries'],
+            }
+            self._write(track, entry)
+        return entry
+
+    def _read(self, track) -> Optional[dict]:
+        path = self._path(track)
+        try:
+            with numpy.load(path) as npz:
+                entry = dict(npz)
+        except (OSError, ValueError):
+            return None
+        if entry.get('version') != CACHE_VERSION or entry.get('mtime') != _mtime(track):
+            return None
+        try:
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:   # Evicted by another writer since it was read
+            pass
+        return entry
+
+    def _write(self, track, entry: dict):
+        # Job workers and the watcher thread may write the same entry at once, so each writes its own temp file
+        path = self._path(track)
+        fd, tmp = tempfile.mkstemp(dir=self._dir, prefix=f'{track.sha1}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.savez(f, **entry)
+            try:
+                os.replace(tmp, path)
+            except OSError:
+                if not path.exists():
+                    raise
+                # Another writer published the entry first
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self._evict()
+
+    def _evict(self):
+        # Other writers may evict the same files at the same time
+        files = []
+        for f in self._dir.glob('*.npz'):
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, f))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, f in files:
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def _graph(entry: dict) -> CheckpointGraph:
+    return CheckpointGraph({'CKPT': {'entries': entry['CKPT']}, 'CKPH': {'entries': entry['CKPH']}})
+
+
+def _mtime(track) -> int:
+    return os.stat(track.dir / 'course.kmp').st_mtime_ns
@@ -8,6 +8,8 @@ MAIN = Path(os.getenv('CT_PATH'))
 CTGP = MAIN / 'CTGP Tracks'
 REGS = MAIN / 'Original Tracks'
 TEMP = MAIN / 'temp'
+CACHE = MAIN / 'cache'
+SNAPSHOT = CACHE / 'tracklists.json'
 
 def clear_temp():
     if len(os.listdir(TEMP)) > 0:
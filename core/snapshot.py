@@ -0,0 +1,85 @@
+import os
+import json
+import time
+from pathlib import Path
+
+from core.tracklists import FilesystemTrackList, SpreadsheetTrackList
+
+# Snapshots with a different version are ignored, so bump this whenever the track list layouts change
+SNAPSHOT_VERSION = 1
+
+
+def save(path: os.PathLike, fs_tracks: FilesystemTrackList, sheet_tracks: SpreadsheetTrackList):
+    """ Writes both track lists to a snapshot file, replacing the old one at once. """
+    path = Path(path)
+    data = {
+        'version': SNAPSHOT_VERSION,
+        'created': time.time(),
+        'filesystem': fs_tracks.snapshot(),
+        'spreadsheet': sheet_tracks.snapshot(),
+    }
+    os.makedirs(path.parent, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def load(path: os.PathLike, fs_tracks: FilesystemTrackList, sheet_tracks: SpreadsheetTrackList) -> tuple[bool, bool]:
+    """
+    Restores both track lists from a snapshot file if there is a usable one.
+
+    :return: Whether the filesystem and spreadsheet track lists were restored
+    """
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return False, False
+    if data.get('version') != SNAPSHOT_VERSION:
+        return False, False
+    restored = []
+    for track_list, key in ((fs_tracks, 'filesystem'), (sheet_tracks, 'spreadsheet')):
+        try:
+            restored.append(track_list.restore(data[key]))
+        except (KeyError, TypeError, ValueError):
+            restored.append(False)
+    return restored[0], restored[1]
+
+
+if __name__ == '__main__':
+    # Startup time of each phase, cold against the live sheet and track folders and then from a snapshot
+    import sys
+    from dotenv import load_dotenv
+    from core import paths
+    from api.spreadsheet import Spreadsheet
+
+    load_dotenv()
+    SHEET_ID = os.getenv('SHEET_ID')
+    snapshot_path = Path(sys.argv[1]) if len(sys.argv) > 1 else paths.SNAPSHOT
+    phases = []
+
+    def timed(label, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        phases.append((label, time.perf_counter() - start))
+        return result
+
+    fs_tracks = timed('Scan track folders', FilesystemTrackList, paths.CTGP)
+    sheet_tracks = SpreadsheetTrackList(None, refresh=False)
+    if SHEET_ID is not None and os.path.isfile('./token.json'):
+        spreadsheet = timed('Connect to spreadsheet', Spreadsheet, SHEET_ID, './token.json')
+        timed('Download spreadsheet', sheet_tracks.connect, spreadsheet)
+    else:
+        print('No SHEET_ID or token.json, skipping the spreadsheet')
+    timed('Save snapshot', save, snapshot_path, fs_tracks, sheet_tracks)
+
+    fs_snap = FilesystemTrackList(paths.CTGP, refresh=False)
+    sheet_snap = SpreadsheetTrackList(None, refresh=False)
+    restored = timed('Load snapshot', load, snapshot_path, fs_snap, sheet_snap)
+    timed('Revalidate track folders', fs_snap.refresh)
+
+    for label, elapsed in phases:
+        print(f'{label:>26}: {elapsed * 1000:9.2f}ms')
+    print(f'Snapshot: {os.path.getsize(snapshot_path)} bytes, {len(fs_snap.names())} filesystem tracks, '
+          f'{len(sheet_snap.names())} spreadsheet tracks, restored {restored}')
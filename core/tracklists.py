@@ -1,15 +1,45 @@
 import os
 import json
-from dataclasses import dataclass
-from typing import Optional
+import random
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from typing import Optional, TYPE_CHECKING
 from pathlib import Path
 from abc import ABC, abstractmethod
 
-from core import command_utils
-from api.spreadsheet import Spreadsheet
+from core.tracksearch import TrackSearchIndex
+from utils.lazyimport import lazy_import
+from api.sheetrange import SheetRange
+
+if TYPE_CHECKING:
+    from api.spreadsheet import Spreadsheet
+
+# Only needed once a spreadsheet is connected, which has imported it already
+gspread = lazy_import('gspread')
+
+
+# Number of resolved queries each track list remembers
+SEARCH_CACHE_SIZE = 512
+# Threads reading info.json files during a filesystem refresh
+REFRESH_THREADS = 16
+# Seconds between checks for spreadsheet changes, give or take the jitter
+SHEET_REFRESH_INTERVAL = 600
+SHEET_REFRESH_JITTER = 60
+# Name, version, unbreakable, RTA status and TAS status of each track, below the header row of the first page
+SHEET_TRACKS = SheetRange(page=0, cells='A2:E', fields=('formattedValue', 'hyperlink'))
 
 
 class TrackList(ABC):
+    def __init__(self):
+        # Search index and the query cache built on it, replaced together in one assignment since refreshes run in
+        # other threads while the event loop is searching
+        self._search: tuple[TrackSearchIndex, OrderedDict[str, Optional[str]]] = (TrackSearchIndex([]), OrderedDict())
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     @property
     @abstractmethod
     def _dict(self) -> dict:
@@ -22,9 +52,45 @@ class TrackList(ABC):
     def names(self):
         return list(self._dict.keys())
 
+    def tracks(self):
+        return list(self._dict.values())
+
     def search(self, track_in):
-        name = command_utils.parse_track_name(track_in, self.names())
-        return self._dict[name] if name is not None else None
+        if track_in in self._dict:  # Already a track name
+            return self._dict[track_in]
+
+        # Resolution only depends on the uppercased words of the query
+        query = ' '.join(track_in.upper().split())
+        index, cache = self._search
+        if query in cache:
+            self.cache_hits += 1
+            cache.move_to_end(query)
+            name = cache[query]
+        else:
+            self.cache_misses += 1
+            name = index.search(query)
+            cache[query] = name
+            if len(cache) > SEARCH_CACHE_SIZE:
+                cache.popitem(last=False)
+        return self._dict.get(name) if name is not None else None
+
+    def cache_info(self) -> str:
+        total = self.cache_hits + self.cache_misses
+        rate = self.cache_hits / total if total else 0
+        return (f'{self.cache_hits} hits, {self.cache_misses} misses ({rate:.1%} hit rate), '
+                f'{len(self._search[1])}/{SEARCH_CACHE_SIZE} cached')
+
+    def complete(self, text: str) -> list[str]:
+        """ Track names to suggest while text is being typed. """
+        return self._search[0].complete(text)
+
+    @staticmethod
+    def _new_search(tracks: dict) -> tuple[TrackSearchIndex, OrderedDict[str, Optional[str]]]:
+        """
+        Search index and an empty query cache for a new track dict. Built before anything is replaced, so a
+        refresh that fails here leaves the list as it was.
+        """
+        return TrackSearchIndex(list(tracks)), OrderedDict()
 
     def __repr__(self):
         return '\n'.join(f'{k}: {v}' for k, v in self._dict.items())
@@ -42,10 +108,14 @@ class FilesystemTrack:
     dir: Path
 
 class FilesystemTrackList(TrackList):
-    def __init__(self, root_dir: os.PathLike):
+    def __init__(self, root_dir: os.PathLike, refresh=True):
+        super().__init__()
         self._root_dir = Path(root_dir)
         self._d = {}
-        self.refresh()
+        self._scan: dict[str, tuple[tuple[int, int], FilesystemTrack]] = {}    # Folder -> (mtimes, track)
+        self._lock = threading.Lock()   # Refreshes may come from the event loop and from a TrackWatcher thread
+        if refresh:
+            self.refresh()
 
     @property
     def _dict(self):
@@ -54,15 +124,102 @@ class FilesystemTrackList(TrackList):
     def search(self, track_in) -> Optional[FilesystemTrack]:
         return super().search(track_in)
 
-    def refresh(self):
-        self._d.clear()
-        for track in os.listdir(self._root_dir):
-            if track.startswith('_'):
+    def refresh(self) -> list[FilesystemTrack]:
+        """
+        Only re-reads info.json for track folders that are new or where the folder or its info.json were modified
+        since the last refresh, reading them in parallel. The track dict is replaced at once rather than cleared
+        and refilled, so readers always see a complete one. Folders without a readable info.json yet are skipped.
+        Returns the tracks that were re-read.
+        """
+        with self._lock:
+            mtimes = {}
+            with os.scandir(self._root_dir) as entries:
+                for entry in entries:
+                    if not entry.name.startswith('_'):
+                        try:
+                            mtimes[entry.name] = self._mtimes(entry.name)
+                        except (FileNotFoundError, NotADirectoryError):
+                            pass
+            return self._load(mtimes)
+
+    def update(self, folders) -> list[FilesystemTrack]:
+        """
+        Like refresh, but only looks at the given track folders, adding, replacing or removing their tracks.
+        Folders without a readable info.json yet are treated as removed. Returns the tracks that were re-read.
+        """
+        with self._lock:
+            mtimes = {folder: m for folder, (m, _) in self._scan.items() if folder not in folders}
+            for folder in folders:
+                if folder.startswith('_'):
+                    continue
+                try:
+                    mtimes[folder] = self._mtimes(folder)
+                except (FileNotFoundError, NotADirectoryError):
+                    pass
+            return self._load(mtimes)
+
+    def snapshot(self) -> dict:
+        """ JSON-serializable state that restore can rebuild the list from without reading any track folders. """
+        with self._lock:
+            return {
+                'root': str(self._root_dir),
+                'folders': {folder: [*m, *(getattr(track, f) for f in _FS_FIELDS)]
+                            for folder, (m, track) in self._scan.items()},
+            }
+
+    def restore(self, snapshot: dict) -> bool:
+        """
+        Replaces the list with a snapshot's tracks. Their folder mtimes are kept, so the next refresh only re-reads
+        folders changed since the snapshot. Returns False without changing anything if the snapshot is of another
+        root folder.
+        """
+        if snapshot['root'] != str(self._root_dir):
+            return False
+        scan = {}
+        tracks = {}
+        for folder, (dir_mtime, info_mtime, *values) in snapshot['folders'].items():
+            track = FilesystemTrack(dir=self._root_dir / folder, **dict(zip(_FS_FIELDS, values, strict=True)))
+            scan[folder] = ((dir_mtime, info_mtime), track)
+            tracks[track.name] = track
+        search = self._new_search(tracks)
+        with self._lock:
+            self._scan, self._d, self._search = scan, tracks, search
+        return True
+
+    def _mtimes(self, folder: str) -> tuple[int, int]:
+        d = self._root_dir / folder
+        return os.stat(d).st_mtime_ns, os.stat(d / 'info.json').st_mtime_ns
+
+    def _load(self, mtimes: dict[str, tuple[int, int]]) -> list[FilesystemTrack]:
+        changed = [folder for folder, m in mtimes.items() if folder not in self._scan or self._scan[folder][0] != m]
+        loaded = {}
+        if changed:
+            with ThreadPoolExecutor(min(REFRESH_THREADS, len(changed))) as pool:
+                loaded = dict(zip(changed, pool.map(self._read_track, changed)))
+
+        scan = {}
+        tracks = {}
+        for folder, m in mtimes.items():
+            track = loaded[folder] if folder in loaded else self._scan[folder][1]
+            if track is None:   # Removed or still being written since its mtimes were read, so try again next time
                 continue
-            d = self._root_dir / track
+            scan[folder] = (m, track)
+            tracks[track.name] = track
+        search = self._new_search(tracks)
+        self._scan, self._d, self._search = scan, tracks, search
+        return [track for track in loaded.values() if track is not None]
+
+    def _read_track(self, folder: str) -> Optional[FilesystemTrack]:
+        d = self._root_dir / folder
+        try:
             with open(d / 'info.json', 'r') as f:
                 info = json.load(f)
-            self._d[info['name']] = FilesystemTrack(dir=d, **info)
+            return FilesystemTrack(dir=d, **info)
+        except (OSError, ValueError, TypeError):
+            return None
+
+
+_FS_FIELDS = [f.name for f in fields(FilesystemTrack) if f.name != 'dir']
 
 
 @dataclass
@@ -77,10 +234,14 @@ class SpreadsheetTrack:
     tas_video: Optional[str]
 
 class SpreadsheetTrackList(TrackList):
-    def __init__(self, spreadsheet: Spreadsheet):
+    def __init__(self, spreadsheet: Optional['Spreadsheet'], refresh=True):
+        super().__init__()
         self._spreadsheet = spreadsheet
         self._d = {}
-        self.refresh()
+        self._revision = None
+        self._lock = threading.Lock()
+        if refresh:
+            self.refresh()
 
     @property
     def _dict(self):
@@ -89,20 +250,75 @@ class SpreadsheetTrackList(TrackList):
     def search(self, track_in) -> Optional[SpreadsheetTrack]:
         return super().search(track_in)
 
-    def refresh(self):
-        self._d.clear()
-        rawdata = self._spreadsheet.get_all_formatted()[0]
-        for row in rawdata[1:]:
-            self._d[row[0]['value']] = SpreadsheetTrack(
-                name        =row[0]['value'],
-                version     =row[1]['value'],
-                unbreakable =row[2]['value'],
-                rta_status  =row[3]['value'],
-                tas_status  =row[4]['value'],
-                wiki_url  =row[0]['link'],
-                rta_video =row[3]['link'],
-                tas_video =row[4]['link'],
-            )
+    def refresh(self, force=False) -> bool:
+        """
+        Downloads the sheet unless its Drive revision is the same as at the last download, and swaps in the new
+        track dict at once. Returns whether it was downloaded, which it never is before a spreadsheet is connected.
+        """
+        with self._lock:
+            if self._spreadsheet is None:
+                return False
+            try:
+                revision = self._spreadsheet.revision()
+            except gspread.exceptions.APIError:
+                revision = None     # Always download if the revision can't be checked
+            if not force and revision is not None and revision == self._revision:
+                return False
+
+            tracks = {}
+            for name, version, unbreakable, rta, tas in self._spreadsheet.get_ranges([SHEET_TRACKS])[0]:
+                if not name[0]:     # Blank row
+                    continue
+                tracks[name[0]] = SpreadsheetTrack(
+                    name        =name[0],
+                    version     =version[0],
+                    unbreakable =unbreakable[0],
+                    rta_status  =rta[0],
+                    tas_status  =tas[0],
+                    wiki_url  =name[1],
+                    rta_video =rta[1],
+                    tas_video =tas[1],
+                )
+            search = self._new_search(tracks)
+            self._d, self._revision, self._search = tracks, revision, search
+            return True
+
+    def connect(self, spreadsheet: 'Spreadsheet') -> bool:
+        """ Sets the spreadsheet to refresh from, for lists created without one, and refreshes from it. """
+        self._spreadsheet = spreadsheet
+        return self.refresh()
+
+    def snapshot(self) -> dict:
+        """ JSON-serializable state that restore can rebuild the list from without downloading the sheet. """
+        with self._lock:
+            return {
+                'revision': self._revision,
+                'tracks': [[getattr(track, f.name) for f in fields(SpreadsheetTrack)] for track in self._d.values()],
+            }
+
+    def restore(self, snapshot: dict) -> bool:
+        """
+        Replaces the list with a snapshot's tracks. Its revision is kept, so the next refresh only downloads the
+        sheet if it changed since the snapshot.
+        """
+        tracks = {values[0]: SpreadsheetTrack(*values) for values in snapshot['tracks']}
+        search = self._new_search(tracks)
+        with self._lock:
+            self._d, self._revision, self._search = tracks, snapshot['revision'], search
+        return True
+
+    async def refresh_async(self, force=False) -> bool:
+        """ Same as refresh, but runs in a worker thread instead of blocking the event loop. """
+        return await asyncio.to_thread(self.refresh, force)
+
+    async def auto_refresh(self, interval=SHEET_REFRESH_INTERVAL, jitter=SHEET_REFRESH_JITTER):
+        """ Checks for changes forever, every interval seconds give or take a random jitter. """
+        while True:
+            await asyncio.sleep(interval + random.uniform(-jitter, jitter))
+            try:
+                await self.refresh_async()
+            except Exception as err:
+                print(f'Spreadsheet refresh failed: {err}')
 
 
 # if __name__ == '__main__':
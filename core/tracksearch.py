@@ -0,0 +1,241 @@
+import heapq
+import difflib
+from typing import Optional
+
+import numpy
+
+# First words that can be skipped when matching the start of a name
+PREFIXES = ['SNES', 'GBA', 'N64', 'GCN', 'DS', 'CTR', 'DKR', 'GP', 'SADX']
+
+# Minimum difflib ratio for full names and for the first words of names
+FULL_CUTOFF = 0.85
+WORDS_CUTOFF = 0.8
+
+# Most choices Discord shows for an autocomplete
+AUTOCOMPLETE_LIMIT = 25
+
+_BYTE_POPCOUNT = numpy.array([bin(b).count('1') for b in range(256)], numpy.uint8)
+
+
+class TrackSearchIndex:
+    """
+    Precomputed lookup tables for resolving free-text input to a track name without redoing the per-name work on
+    every query.
+    """
+
+    def __init__(self, names: list[str]):
+        self.names = list(names)
+        self._upper = [n.upper() for n in self.names]
+        self._words = [n.split() for n in self._upper]
+        self._abbrevs: dict[str, list[int]] = {}
+        for i, n in enumerate(self.names):
+            self._abbrevs.setdefault(''.join(c for c in n if c.isupper() or c.isnumeric()), []).append(i)
+        self._choices: dict[int, _Choices] = {}
+
+        # Alphabetical prefix trie of whole names, followed by the rest of each name from every later word
+        self._trie = _PrefixTrie(AUTOCOMPLETE_LIMIT)
+        alphabetical = sorted(range(len(self.names)), key=lambda i: self._upper[i])
+        for i in alphabetical:
+            self._trie.insert(self._upper[i], i)
+        for i in alphabetical:
+            for w in range(1, len(self._words[i])):
+                self._trie.insert(' '.join(self._words[i][w:]), i)
+
+    def search(self, track_in: str) -> Optional[str]:
+        """ Returns the closest matching track name, or None if no matches. """
+        query = track_in.upper()
+        choices = self._choices_for(len(track_in.split()))
+        scores = choices.scores(query)
+
+        # Step 1: Looks for full track name, autocorrects slightly
+        matches = choices.close_matches(query, scores, 0, 1, FULL_CUTOFF)
+        if matches:
+            return self.names[matches[0]]
+
+        # Step 2: Looks for abbreviations
+        abbrev_matches = self._abbrevs.get(track_in.replace(' ', '').upper())
+        if abbrev_matches:
+            return self.names[abbrev_matches[0]]
+
+        # Step 3: Looks for the first words of the name, with or without a prefix
+        for n in range(2):
+            fmatches = choices.close_matches(query, scores, n + 1, 3, WORDS_CUTOFF)
+            if 0 < len(fmatches) < 3:
+                return self.names[fmatches[0]]
+
+        return None
+
+    def complete(self, text: str, limit: int = AUTOCOMPLETE_LIMIT) -> list[str]:
+        """
+        Track names to suggest for partial input: names it abbreviates, then names starting with it, then names
+        with a later word starting with it. Falls back to the search result if none match.
+        """
+        key = ' '.join(text.upper().split())
+        if key and text[-1].isspace():
+            key += ' '
+        found = list(self._abbrevs.get(key.replace(' ', ''), []))
+        found += [i for i in self._trie.get(key) if i not in found]
+        if not found and key:
+            best = self.search(text)
+            return [best] if best is not None else []
+        return [self.names[i] for i in found[:limit]]
+
+    def _choices_for(self, num_words: int) -> '_Choices':
+        """
+        Full names, then the first num_words words of every name, then the first num_words words after a prefix,
+        so a query is scored against all of them in one pass.
+        """
+        if num_words not in self._choices:
+            segments = [(self._upper, list(range(len(self.names))))]
+            for skip in range(2):
+                strings = []
+                indices = []
+                for i, words in enumerate(self._words):
+                    if len(words[skip:]) >= num_words and (skip == 0 or words[0] in PREFIXES):
+                        strings.append(' '.join(words[skip:num_words + skip]))
+                        indices.append(i)
+                segments.append((strings, indices))
+            self._choices[num_words] = _Choices(segments)
+        return self._choices[num_words]
+
+
+class _PrefixTrie:
+    """ Maps every prefix of the inserted keys to the first few values inserted under it. """
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._root = ({}, [])   # (children by character, values)
+
+    def insert(self, key: str, value):
+        node = self._root
+        self._add(node, value)
+        for c in key:
+            node = node[0].setdefault(c, ({}, []))
+            self._add(node, value)
+
+    def get(self, prefix: str) -> list:
+        node = self._root
+        for c in prefix:
+            node = node[0].get(c)
+            if node is None:
+                return []
+        return node[1]
+
+    def _add(self, node, value):
+        if len(node[1]) < self._limit and value not in node[1]:
+            node[1].append(value)
+
+
+class _Choices:
+    """
+    Candidate strings scored against a query all at once with bit-parallel LCS (Allison-Dix/Hyyro), one bit lane
+    per candidate, so every candidate is scored in a single pass over the query's characters. Candidates are
+    split into segments, each matched separately.
+
+    LCS similarity is never lower than difflib's ratio, so it rules out most candidates cheaply, and only the few
+    that pass the cutoff are re-checked with difflib to keep matching the same as before.
+    """
+
+    def __init__(self, segments: list[tuple[list[str], list[int]]]):
+        self.strings = [s for strings, _ in segments for s in strings]
+        self.indices = [i for _, indices in segments for i in indices]
+        ends = numpy.cumsum([len(strings) for strings, _ in segments]).tolist()
+        self._segments = list(zip([0] + ends[:-1], ends))
+        self._lengths = numpy.array([len(s) for s in self.strings], int)
+
+        # Candidates longer than a machine word fall back to Python ints
+        dtype = numpy.uint64 if self._lengths.max(initial=0) <= 64 else object
+        self._columns = {c: j for j, c in enumerate(sorted(set(''.join(self.strings))))}
+        # Bit j of a candidate's entry in row c is set where its character j is c, plus a zero row for characters
+        # no candidate has
+        match = [[0] * len(self.strings) for _ in range(len(self._columns) + 1)]
+        for i, s in enumerate(self.strings):
+            for j, c in enumerate(s):
+                match[self._columns[c]][i] |= 1 << j
+        self._match = numpy.array(match, dtype).reshape(len(match), len(self.strings))
+        self._mask = numpy.array([(1 << len(s)) - 1 for s in self.strings], dtype)
+
+    def scores(self, word: str) -> numpy.ndarray:
+        """ 2 * LCS / (total length) of the word against every candidate, on the same scale as difflib's ratio. """
+        unknown = len(self._columns)
+        v = self._mask.copy()
+        for row in self._match[[self._columns.get(c, unknown) for c in word]]:
+            u = v & row
+            v = (v + u) | (v ^ u)   # Carries above a candidate's length never reach the bits below it
+        v &= self._mask
+        if v.dtype == object:
+            unmatched = numpy.array([bin(x).count('1') for x in v], int)
+        else:
+            unmatched = _BYTE_POPCOUNT[v.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+        length = self._lengths + len(word)
+        common = self._lengths - unmatched
+        return numpy.divide(2.0 * common, length, out=numpy.ones(len(length)), where=length > 0)
+
+    def close_matches(self, word: str, scores: numpy.ndarray, segment: int, n: int, cutoff: float) -> list[int]:
+        """
+        Same as difflib.get_close_matches over one segment's strings, but returns the index of the track each
+        match belongs to (the first, for strings that appear more than once in the segment).
+        """
+        start, end = self._segments[segment]
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(word)
+        result = []
+        for i in start + numpy.flatnonzero(scores[start:end] >= cutoff):
+            matcher.set_seq1(self.strings[i])
+            ratio = matcher.ratio()
+            if ratio >= cutoff:
+                result.append((ratio, self.strings[i]))
+        return [self.indices[self.strings.index(x, start, end)] for _, x in heapq.nlargest(n, result)]
+
+
+if __name__ == '__main__':
+    # Benchmark against difflib matching, using queries from a file (one per line) or made up from track names
+    import sys
+    import time
+    import random
+    import difflib
+    from core import paths
+    from core.tracklists import FilesystemTrackList
+
+    track_names = FilesystemTrackList(paths.CTGP).names()
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as f:
+            queries = [q.strip() for q in f if q.strip()]
+    else:
+        rnd = random.Random(0)
+        queries = []
+        for name in track_names:
+            typo = list(name.lower())
+            typo[rnd.randrange(len(typo))] = rnd.choice('abcdefghijklmnopqrstuvwxyz')
+            queries += [name, ''.join(typo), ''.join(c for c in name if c.isupper() or c.isnumeric()),
+                        ' '.join(name.split()[:2]), ' '.join(name.split()[1:2])]
+
+    start = time.perf_counter()
+    index = TrackSearchIndex(track_names)
+    build = time.perf_counter() - start
+
+    def difflib_search(track_in):
+        query = track_in.upper()
+        matches = difflib.get_close_matches(query, index._upper, 1, 0.85)
+        if matches:
+            return track_names[index._upper.index(matches[0])]
+        abbrev_matches = index._abbrevs.get(track_in.replace(' ', '').upper())
+        if abbrev_matches:
+            return track_names[abbrev_matches[0]]
+        choices = index._choices_for(len(track_in.split()))
+        for n in (1, 2):
+            lo, hi = choices._segments[n]
+            fmatches = difflib.get_close_matches(query, choices.strings[lo:hi], 3, 0.8)
+            if 0 < len(fmatches) < 3:
+                return track_names[choices.indices[choices.strings.index(fmatches[0], lo, hi)]]
+        return None
+
+    results = {}
+    for label, resolve in (('difflib', difflib_search), ('TrackSearchIndex', index.search)):
+        start = time.perf_counter()
+        results[label] = [resolve(q) for q in queries]
+        elapsed = time.perf_counter() - start
+        print(f'{label:>16}: {elapsed / len(queries) * 1e6:.1f}us per query')
+    mismatches = sum(a != b for a, b in zip(*results.values()))
+    print(f'{len(queries)} queries, {len(track_names)} tracks, index built in {build * 1000:.2f}ms, '
+          f'{mismatches} mismatches')
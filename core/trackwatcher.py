@@ -0,0 +1,197 @@
+import os
+import sys
+import ctypes
+import struct
+import asyncio
+from typing import Callable, Optional
+
+from core.tracklists import FilesystemTrack, FilesystemTrackList
+
+DEBOUNCE = 0.5          # Seconds without events before changed folders are re-read
+POLL_INTERVAL = 30      # Seconds between incremental refreshes where inotify isn't available
+
+# inotify event masks (sys/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+ROOT_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+FOLDER_MASK = IN_CLOSE_WRITE | IN_MODIFY | IN_ATTRIB | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+_EVENT = struct.Struct('iIII')
+
+
+class TrackWatcher:
+    """
+    Keeps a FilesystemTrackList up to date by watching its root and track folders with inotify. Once events have
+    settled for DEBOUNCE seconds, only the folders they touched are re-read, and listeners are called with the
+    tracks that were re-read. Where inotify isn't available, polls with incremental refreshes instead.
+    """
+
+    def __init__(self, track_list: FilesystemTrackList, root_dir: os.PathLike, debounce: float = DEBOUNCE):
+        self._tracks = track_list
+        self._root_dir = os.fspath(root_dir)
+        self._debounce = debounce
+        self._listeners: list[Callable[[list[FilesystemTrack]], None]] = []
+        self._inotify: Optional[_Inotify] = None
+        self._wds: dict[int, Optional[str]] = {}     # Watch descriptor -> track folder, None for the root
+        self._pending: set[str] = set()
+        self._rescan = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._poller: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def add_listener(self, callback: Callable[[list[FilesystemTrack]], None]):
+        """ Called from a worker thread with the re-read tracks after each update. """
+        self._listeners.append(callback)
+
+    @property
+    def running(self) -> bool:
+        return self._inotify is not None or self._poller is not None
+
+    def start(self):
+        """ Starts watching from the running event loop. Does nothing if already started. """
+        if self.running:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            self._inotify = _Inotify()
+        except OSError:
+            self._poller = loop.create_task(self._poll())
+            return
+        self._watch_all()
+        loop.add_reader(self._inotify.fd, self._on_events)
+
+    def stop(self):
+        if self._inotify is not None:
+            asyncio.get_running_loop().remove_reader(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+            self._wds.clear()
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def _watch_all(self):
+        self._wds[self._inotify.add_watch(self._root_dir, ROOT_MASK)] = None
+        with os.scandir(self._root_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    self._watch_folder(entry.name)
+
+    def _watch_folder(self, folder: str):
+        try:
+            self._wds[self._inotify.add_watch(os.path.join(self._root_dir, folder), FOLDER_MASK)] = folder
+        except OSError:     # Already gone again
+            pass
+
+    def _on_events(self):
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self._rescan = True
+            elif mask & IN_IGNORED:
+                if self._wds.pop(wd, 0) is None:    # Root folder was deleted or moved
+                    self._rescan = True
+            elif wd in self._wds:
+                folder = self._wds[wd]
+                if folder is None:
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                        self._rescan = True
+                        continue
+                    folder = name
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        self._watch_folder(folder)
+                self._pending.add(folder)
+
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(self._debounce, self._flush)
+
+    def _flush(self):
+        self._timer = None
+        folders = self._pending
+        self._pending = set()
+        rescan = self._rescan
+        self._rescan = False
+        if rescan:
+            # Watches may be gone along with the root, so start over once it exists again
+            for wd in list(self._wds):
+                self._inotify.remove_watch(wd)
+            self._wds.clear()
+            if not os.path.isdir(self._root_dir):
+                self._rescan = True
+                self._timer = asyncio.get_running_loop().call_later(self._debounce, self._flush)
+                return
+            self._watch_all()
+        asyncio.get_running_loop().create_task(self._apply(None if rescan else folders))
+
+    async def _apply(self, folders: Optional[set[str]]):
+        async with self._lock:
+            try:
+                await asyncio.to_thread(self._update, folders)
+            except Exception as err:    # Keep watching, the next change or poll will try again
+                print(f'Track folder update failed: {err!r}')
+
+    def _update(self, folders: Optional[set[str]]):
+        changed = self._tracks.refresh() if folders is None else self._tracks.update(folders)
+        if changed:
+            for callback in self._listeners:
+                callback(changed)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            await self._apply(None)
+
+
+class _Inotify:
+    """ Minimal non-blocking inotify instance through libc. """
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def remove_watch(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> list[tuple[int, int, str]]:
+        """ Returns (watch descriptor, mask, name) of every queued event. """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, pos)
+                pos += _EVENT.size
+                name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+                pos += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
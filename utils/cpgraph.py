@@ -0,0 +1,115 @@
+import numpy
+
+
+class CheckpointGraph:
+    """
+    Checkpoint connectivity and lap completion precomputed once from a KMP's CKPT and CKPH sections.
+
+    Adjacency arrays are padded with -1 where the KMP uses 255. Accepts entries from either kmpreader engine.
+    """
+
+    def __init__(self, kmp):
+        ckpt = kmp['CKPT']['entries']
+        ckph = kmp['CKPH']['entries']
+        self.cp_count = len(ckpt)
+        self.group_count = len(ckph)
+
+        # Checkpoints
+        self.p1 = _column(ckpt, 'p1', float).reshape(-1, 2)
+        self.p2 = _column(ckpt, 'p2', float).reshape(-1, 2)
+        self.type = _column(ckpt, 'type', int)
+        cp_prev = _column(ckpt, 'prev', int)
+        cp_next = _column(ckpt, 'next', int)
+
+        # Groups
+        self.group_start = _column(ckph, 'start', int)
+        self.group_len = _column(ckph, 'len', int)
+        self.group_prev = _padded(_column(ckph, 'prev', int).reshape(-1, 6))
+        self.group_next = _padded(_column(ckph, 'next', int).reshape(-1, 6))
+        self.group = numpy.full(self.cp_count, -1)
+        for g in range(self.group_count):
+            self.group[self.group_start[g]:self.group_start[g] + self.group_len[g]] = g
+        self.layer = _group_layers(self.group_next)
+
+        # Checkpoint adjacency, crossing group boundaries where CKPT prev/next is 255
+        group_end = self.group_start + self.group_len - 1
+        cps = numpy.arange(self.cp_count)
+        self.prev = numpy.full((self.cp_count, 6), -1)
+        self.next = numpy.full((self.cp_count, 6), -1)
+        if self.cp_count:
+            gprev = self.group_prev[self.group]
+            gnext = self.group_next[self.group]
+            self.prev[:] = numpy.where(gprev >= 0, group_end[gprev], -1)
+            self.next[:] = numpy.where(gnext >= 0, self.group_start[gnext], -1)
+            inner_prev = cp_prev != 255
+            inner_next = cp_next != 255
+            self.prev[inner_prev] = -1
+            self.prev[inner_prev, 0] = cps[inner_prev] - 1
+            self.next[inner_next] = -1
+            self.next[inner_next, 0] = cps[inner_next] + 1
+
+        # Lap completion, only defined for tracks with exactly one finish line
+        kcp0s = numpy.flatnonzero(self.type == 0)
+        self.kcp0 = int(kcp0s[0]) if len(kcp0s) == 1 else None
+        self.total_layers = 0
+        self.completion = None
+        if self.kcp0 is not None:
+            last_groups = self.group_prev[self.group[self.kcp0]]
+            last_groups = last_groups[last_groups >= 0]
+            self.total_layers = int(self.layer[last_groups].max(initial=0))
+        if self.total_layers > 0:
+            g = self.group
+            self.completion = ((cps - self.group_start[g]) / self.group_len[g] + self.layer[g] - 1) / self.total_layers
+
+    def prevs(self, i: int) -> list[int]:
+        return [int(j) for j in self.prev[i] if j >= 0]
+
+    def nexts(self, i: int) -> list[int]:
+        return [int(j) for j in self.next[i] if j >= 0]
+
+    def group_ends(self, groups) -> list[int]:
+        """ Last checkpoint of each valid group index. """
+        return [int(self.group_start[g] + self.group_len[g] - 1) for g in groups if g >= 0]
+
+    def group_starts(self, groups) -> list[int]:
+        """ First checkpoint of each valid group index. """
+        return [int(self.group_start[g]) for g in groups if g >= 0]
+
+
+def checkpoint_graph(kmp) -> CheckpointGraph:
+    """ Returns kmp itself if it is already a CheckpointGraph, otherwise builds one. """
+    return kmp if isinstance(kmp, CheckpointGraph) else CheckpointGraph(kmp)
+
+
+def _column(entries, field: str, dtype) -> numpy.ndarray:
+    if isinstance(entries, numpy.ndarray):
+        return entries[field].astype(dtype)
+    return numpy.array([e[field] for e in entries], dtype)
+
+
+def _padded(links: numpy.ndarray) -> numpy.ndarray:
+    return numpy.where(links == 255, -1, links)
+
+
+def _group_layers(group_next: numpy.ndarray) -> numpy.ndarray:
+    """
+    Assigns each group its layer, walking from group 0 in the same order as kmpreader.compute_ckph_layers,
+    but with an explicit stack so long group chains can't hit the recursion limit.
+    """
+    layer = numpy.full(len(group_next), -1)
+    if len(group_next) == 0:
+        return layer
+    layer[0] = 1
+    if len(group_next) == 1:
+        return layer
+    stack = [(0, iter(group_next[0]))]
+    while stack:
+        g, children = stack[-1]
+        for i in children:
+            if i >= 0 and layer[i] == -1:
+                layer[i] = layer[g] + 1
+                stack.append((i, iter(group_next[i])))
+                break
+        else:
+            stack.pop()
+    return layer
@@ -1,6 +1,25 @@
+import io
+import os
 import sys
+import gzip
+import zipfile
+from pathlib import Path
+from collections import Counter
+from typing import Iterator, Optional
+
 import numpy
-from scipy.optimize import linprog
+from attr import dataclass
+
+from utils.cpgraph import CheckpointGraph, checkpoint_graph
+from utils.lazyimport import lazy_import
+
+# Only the 'lp' engine needs scipy, which is slow to import
+optimize = lazy_import('scipy.optimize')
+
+ENGINES = ('lp', 'clip')
+CLIP_TOLERANCE = 1e-6       # Distance a point may lie outside a half-plane and still count as inside
+CLIP_UNBOUNDED = 1e9        # Half-width of the starting box when called without bounds
+POLYGON_MIN_AREA = 1.0      # Polygons smaller than this many square units aren't drawn
 
 RED = '#c74440'
 BLUE = '#2d70b3'
@@ -9,14 +28,68 @@ PURPLE = '#6042a6'
 ORANGE = '#fa7e19'
 
 
-def graph(kmp, gcplist: list, splitpaths=False, fillquads=True, dev=False, bounds=(None, None)):
+def graph(kmp, gcplist: list, splitpaths=False, fillquads=True, dev=False, bounds=(None, None), numeric=False):
+    """
+    Generates a Desmos graph of the track's checkpoints as an HTML page.
+
+    :param numeric: Draw regions as precomputed polygons instead of symbolic inequalities for Desmos to solve,
+                    which makes the file much smaller and faster to render
+    """
+    out = io.StringIO()
+    write_graph(out, kmp, gcplist, splitpaths, fillquads, dev, bounds, numeric)
+    return out.getvalue()
+
+
+def write_graph(out, kmp, gcplist: list, splitpaths=False, fillquads=True, dev=False, bounds=(None, None),
+                numeric=False):
+    """ Same as graph, but writes the page to a text stream one expression at a time instead of returning it. """
     if gcplist is None:
         gcplist = ['']
-    ckpt = kmp['CKPT']['entries']
-    ckph = kmp['CKPH']['entries']
-    numcps = len(ckpt)
-    group = 0
-    script = []
+    cpg = checkpoint_graph(kmp)
+    if numeric:
+        expressions = _numeric_expressions(cpg, gcplist, splitpaths, fillquads, bounds)
+    else:
+        expressions = _symbolic_expressions(cpg, gcplist, splitpaths, fillquads, bounds)
+
+    out.write(_DESMOS_HEAD.format(dev='true' if dev else 'false'))
+    for n, expression in enumerate(expressions):
+        if n:
+            out.write(',\n')
+        out.write(expression)
+    out.write(_DESMOS_TAIL)
+
+
+def save_graph(path: os.PathLike, kmp, gcplist: list, *args, compression=None, **kwargs) -> Path:
+    """
+    Streams the graph to a file, taking the same arguments as graph. Returns the path written to.
+
+    :param compression: None, 'gzip' or 'zip'. Compressed files get .gz or .zip appended to the path, with the zip
+                        holding a single HTML file named after the original path
+    """
+    path = Path(path)
+    if compression is None:
+        with open(path, 'w', encoding='utf-8') as out:
+            write_graph(out, kmp, gcplist, *args, **kwargs)
+    elif compression == 'gzip':
+        path = path.with_name(path.name + '.gz')
+        with gzip.open(path, 'wt', encoding='utf-8') as out:
+            write_graph(out, kmp, gcplist, *args, **kwargs)
+    elif compression == 'zip':
+        member = path.name
+        path = path.with_name(path.name + '.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf, zf.open(member, 'w') as raw:
+            with io.TextIOWrapper(raw, encoding='utf-8') as out:
+                write_graph(out, kmp, gcplist, *args, **kwargs)
+    else:
+        raise ValueError(f'Unknown compression: {compression}')
+    return path
+
+
+def _symbolic_expressions(cpg, gcplist: list, splitpaths: bool, fillquads: bool, bounds) -> Iterator[str]:
+    numcps = cpg.cp_count
+    p1 = cpg.p1.tolist()
+    p2 = cpg.p2.tolist()
+    types = cpg.type.tolist()
 
     a_ = []
     b_ = []
@@ -37,83 +110,54 @@ def graph(kmp, gcplist: list, splitpaths=False, fillquads=True, dev=False, bound
                   f'+\\\\ ({d_[i]}-{b_[i]})^{{2}})^{{0.5}}}}')
         vneg.append(f'{s0[i]}(x-{c_[i]})+{s1[i]}(y-{d_[i]})')
 
-    def to_script(latex: str, color_='', label=''):
-        string = f'{{ latex: \'{latex}\''
-        if color_:
-            string += f', color: \'{color_}\''
-        if label:
-            string += f', label: \'{label}\', pointSize: 5, pointOpacity: 0.5, dragMode: Desmos.DragModes.NONE'
-        string += ' }'
-        script.append(string)
-
     for i in range(numcps):
-        if ckpt[i]['prev'] == 255:
-            prevs = [ckph[j]['start'] + ckph[j]['len'] - 1 for j in ckph[group]['prev'] if j != 255]
-        else:
-            prevs = [i - 1]
-
-        if ckpt[i]['next'] == 255:
-            nexts = [ckph[j]['start'] for j in ckph[group]['next'] if j != 255]
-            group += 1
-        else:
-            nexts = [i + 1]
-
-        if i in gcplist:
-            color = RED
-        elif ckpt[i]['type'] == 255:
-            color = BLUE
-        elif ckpt[i]['type'] == 0:
-            color = GREEN
-        else:
-            color = PURPLE
+        prevs = cpg.prevs(i)
+        nexts = cpg.nexts(i)
+        color = RED if i in gcplist else _cp_color(types[i])
 
         # Coordinates
-        to_script(f'{a_[i]}={ckpt[i]["p1"][0]}')
-        to_script(f'{b_[i]}={ckpt[i]["p1"][1] * -1}')
-        to_script(f'{c_[i]}={ckpt[i]["p2"][0]}')
-        to_script(f'{d_[i]}={ckpt[i]["p2"][1] * -1}')
+        yield _expression(f'{a_[i]}={p1[i][0]}')
+        yield _expression(f'{b_[i]}={p1[i][1] * -1}')
+        yield _expression(f'{c_[i]}={p2[i][0]}')
+        yield _expression(f'{d_[i]}={p2[i][1] * -1}')
 
         # Points
-        to_script(f'({a_[i]}, {b_[i]})', color)
-        to_script(f'({c_[i]}, {d_[i]})', color)
-        to_script(f'(0.5({a_[i]}+{c_[i]}),0.5({b_[i]}+{d_[i]}))', color, label=str(i))
+        yield _expression(f'({a_[i]}, {b_[i]})', color)
+        yield _expression(f'({c_[i]}, {d_[i]})', color)
+        yield _expression(f'(0.5({a_[i]}+{c_[i]}),0.5({b_[i]}+{d_[i]}))', color, label=str(i))
 
         # Checkpoint line
-        to_script(f'((1-t){a_[i]}+t{c_[i]},(1-t){b_[i]}+t{d_[i]})', color)
+        yield _expression(f'((1-t){a_[i]}+t{c_[i]},(1-t){b_[i]}+t{d_[i]})', color)
 
-        if ckpt[i]['type'] == 255:
-            color = BLUE
-        elif ckpt[i]['type'] == 0:
-            color = GREEN
-        else:
-            color = PURPLE
+        color = _cp_color(types[i])
 
         for nexti in nexts:
             vborder1 = f'-({b_[nexti]}-{b_[i]})(x-{a_[nexti]})+({a_[nexti]}-{a_[i]})(y-{b_[nexti]})'
             vborder2 = f'(({d_[nexti]}-{d_[i]})(x-{c_[i]})-({c_[nexti]}-{c_[i]})(y-{d_[i]}))'
 
-            to_script(f'B_{{{i}t{nexti}}}=({vborder1}) * {vborder2} + \\\\left|{vborder1}\\\\right| * -{vborder2}')
-            to_script(f'F_{{{i}t{nexti}}}=\\\\frac{{{vneg[i]}}}{{{vneg[i]} - '
+            yield _expression(f'B_{{{i}t{nexti}}}=({vborder1}) * {vborder2} + '
+                              f'\\\\left|{vborder1}\\\\right| * -{vborder2}')
+            yield _expression(f'F_{{{i}t{nexti}}}=\\\\frac{{{vneg[i]}}}{{{vneg[i]} - '
                       f'({s0[nexti]}(x-{a_[nexti]})+{s1[nexti]}(y-{b_[nexti]}))}}')
 
             # Quadrilateral shading
             if fillquads:
-                to_script(f'B_{{{i}t{nexti}}} > 0 \\\\left\\\\{{R_{{{nexti}t{i}}} > 0'
+                yield _expression(f'B_{{{i}t{nexti}}} > 0 \\\\left\\\\{{R_{{{nexti}t{i}}} > 0'
                           f'\\\\right\\\\}} \\\\left\\\\{{F_{{{i}t{nexti}}} > 0\\\\right\\\\}}', color)
 
             # Split path GCPs (beginning of split path)
             if splitpaths and len(nexts) > 1:  # and ckpt[i]['type'] == 255:
-                to_script(f'B_{{{nexti}t{nexti + 1}}} > 0 ' +
+                yield _expression(f'B_{{{nexti}t{nexti + 1}}} > 0 ' +
                           ''.join(f'\\\\left\\\\{{B_{{{i}t{other}}} > 0\\\\right\\\\}}' for other in nexts if other != nexti) +
                           f'\\\\left\\\\{{{vneg[i]} > 0\\\\right\\\\}}', ORANGE)
 
         for previ in prevs:
-            to_script(f'R_{{{i}t{previ}}}=\\\\frac{{{vneg[i]}}}{{{vneg[i]} - '
+            yield _expression(f'R_{{{i}t{previ}}}=\\\\frac{{{vneg[i]}}}{{{vneg[i]} - '
                       f'({s0[previ]}(x-{a_[previ]})+{s1[previ]}(y-{b_[previ]}))}}')
 
             # Split path GCPs (end of split path)
             if splitpaths and len(prevs) > 1:  # and ckpt[i]['type'] == 255:
-                to_script(f'B_{{{previ}t{i}}} > 0 \\\\left\\\\{{B_{{{i}t{i + 1}}} > 0\\\\right\\\\}} '
+                yield _expression(f'B_{{{previ}t{i}}} > 0 \\\\left\\\\{{B_{{{i}t{i + 1}}} > 0\\\\right\\\\}} '
                           f'\\\\left\\\\{{{vneg[i]} < 0\\\\right\\\\}}', ORANGE)
 
         # Normal GCPs
@@ -124,33 +168,264 @@ def graph(kmp, gcplist: list, splitpaths=False, fillquads=True, dev=False, bound
                 if bounds[0] is not None:
                     gcp_area += f'\\\\left\\\\{{{bounds[0]}<x<{bounds[1]}\\\\right\\\\}}' \
                               f'\\\\left\\\\{{{bounds[0]}<y<{bounds[1]}\\\\right\\\\}}'
-                to_script(gcp_area, RED)
+                yield _expression(gcp_area, RED)
 
-    expressions = ',\n'.join(script)
 
-    return f'''
+
+def _numeric_expressions(cpg, gcplist: list, splitpaths: bool, fillquads: bool, bounds) -> Iterator[str]:
+    """
+    Same drawing as _symbolic_expressions, but each region is computed here as the union of convex polygons.
+
+    Each shaded inequality of the form X / (X - Y) > 0 holds where X and X - Y have the same sign, so every region
+    splits into one half-plane intersection per sign combination, clipped to the bounds box all at once.
+    """
+    numcps = cpg.cp_count
+    types = cpg.type.tolist()
+    a, b = cpg.p1[:, 0], -cpg.p1[:, 1]
+    c, d = cpg.p2[:, 0], -cpg.p2[:, 1]
+    length = numpy.hypot(a - c, d - b)
+    length[length == 0] = sys.float_info.min
+    s0 = (d - b) / length
+    s1 = (a - c) / length
+
+    # Linear functions as [x, y, 1] coefficients: signed distance past each checkpoint line, measured from each end
+    vneg = numpy.stack([s0, s1, -s0 * c - s1 * d], axis=-1)
+    vpos = numpy.stack([s0, s1, -s0 * a - s1 * b], axis=-1)
+
+    def borders(i, n):
+        """ Sides of the quad from checkpoint(s) i to n, each negative inside the quad. """
+        v1, v2 = -(b[n] - b[i]), a[n] - a[i]
+        w1, w2 = d[n] - d[i], -(c[n] - c[i])
+        return (numpy.stack([v1, v2, -a[n] * v1 - b[n] * v2], axis=-1),
+                numpy.stack([w1, w2, -c[i] * w1 - d[i] * w2], axis=-1))
+
+    for i in range(numcps):
+        color = RED if i in gcplist else _cp_color(types[i])
+        yield _expression(f'({_num(a[i])},{_num(b[i])})', color)
+        yield _expression(f'({_num(c[i])},{_num(d[i])})', color)
+        yield _expression(f'({_num((a[i] + c[i]) / 2)},{_num((b[i] + d[i]) / 2)})', color, label=str(i))
+        yield _expression(f'((1-t){_num(a[i])}+t{_num(c[i])},(1-t){_num(b[i])}+t{_num(d[i])})', color)
+
+    # Quadrilateral shading, one system per (checkpoint, next) pair and sign combination
+    ei, slot = numpy.nonzero(cpg.next >= 0)
+    en = cpg.next[ei, slot]
+    if fillquads and len(ei):
+        left, right = borders(ei, en)
+        pieces = [numpy.stack([left, right, -s1_ * vneg[en], -s1_ * (vneg[en] - vpos[ei]),
+                               -s2_ * vneg[ei], -s2_ * (vneg[ei] - vpos[en])], axis=1)
+                  for s1_ in (1, -1) for s2_ in (1, -1)]
+        colors = [_cp_color(types[i]) for i in ei]
+        yield from _polygons(numpy.stack(pieces, axis=1).reshape(-1, 6, 3), [col for col in colors for _ in range(4)],
+                            bounds)
+
+    # Split path GCPs
+    if splitpaths:
+        systems = []
+        for i in range(numcps):
+            nexts = cpg.nexts(i)
+            prevs = cpg.prevs(i)
+            if len(nexts) > 1:     # Beginning of split path
+                for nexti in nexts:
+                    if nexti + 1 not in cpg.nexts(nexti):
+                        continue
+                    rows = list(borders(nexti, nexti + 1))
+                    for other in nexts:
+                        if other != nexti:
+                            rows += borders(i, other)
+                    systems.append(rows + [-vneg[i]])
+            if len(prevs) > 1 and i + 1 in nexts:     # End of split path
+                for previ in prevs:
+                    systems.append([*borders(previ, i), *borders(i, i + 1), vneg[i]])
+        if systems:
+            width = max(len(rows) for rows in systems)
+            padded = numpy.zeros((len(systems), width, 3))
+            padded[..., 2] = -1     # 0x + 0y - 1 <= 0 always holds
+            for n, rows in enumerate(systems):
+                padded[n, :len(rows)] = rows
+            yield from _polygons(padded, [ORANGE] * len(systems), bounds)
+
+    # Normal GCPs, one system per (previous, checkpoint, next) triple and side of the checkpoint line
+    ti, pslot, nslot = numpy.nonzero((cpg.prev[:, :, None] >= 0) & (cpg.next[:, None, :] >= 0))
+    tp = cpg.prev[ti, pslot]
+    tn = cpg.next[ti, nslot]
+    if len(ti):
+        rows = [*borders(tp, ti), *borders(ti, tn)]
+        pieces = [numpy.stack(rows + [-side * vneg[ti], side * (vneg[ti] - vpos[tp]), side * (vneg[ti] - vpos[tn])],
+                              axis=1) for side in (1, -1)]
+        yield from _polygons(numpy.stack(pieces, axis=1).reshape(-1, 7, 3), [RED] * (2 * len(ti)), bounds)
+
+
+
+def _polygons(systems, colors: list[str], bounds) -> Iterator[str]:
+    """ Clips each system of half-planes f . [x, y, 1] <= 0 and draws the non-degenerate results as polygons. """
+    poly, nverts = clip_halfplanes(systems[..., :2], -systems[..., 2], bounds)
+    # Clipping leaves repeated vertices and zero-area slivers behind, which would only bloat the output
+    for n in numpy.flatnonzero((nverts >= 3) & (_shoelace_area(poly, nverts) > POLYGON_MIN_AREA)):
+        points = [f'({_num(x)},{_num(y)})' for x, y in poly[n, :nverts[n]]]
+        points = [p for i, p in enumerate(points) if p != points[i - 1]]
+        if len(points) >= 3:
+            yield _expression(f'\\\\operatorname{{polygon}}({",".join(points)})', colors[n])
+
+
+def _shoelace_area(poly: numpy.ndarray, nverts: numpy.ndarray) -> numpy.ndarray:
+    """ Area of each polygon from its first nverts vertices. """
+    idx = numpy.arange(poly.shape[1])
+    valid = idx < nverts[:, None]
+    nxt = numpy.take_along_axis(poly, ((idx + 1) % numpy.maximum(nverts, 1)[:, None])[..., None], axis=1)
+    with numpy.errstate(invalid='ignore', over='ignore'):
+        cross = poly[..., 0] * nxt[..., 1] - nxt[..., 0] * poly[..., 1]
+    return 0.5 * numpy.abs(numpy.where(valid, cross, 0).sum(axis=1))
+
+
+def _expression(latex: str, color='', label='') -> str:
+    string = f'{{ latex: \'{latex}\''
+    if color:
+        string += f', color: \'{color}\''
+    if label:
+        string += f', label: \'{label}\', pointSize: 5, pointOpacity: 0.5, dragMode: Desmos.DragModes.NONE'
+    string += ' }'
+    return string
+
+
+def _cp_color(cptype: int) -> str:
+    if cptype == 255:
+        return BLUE
+    elif cptype == 0:
+        return GREEN
+    return PURPLE
+
+
+def _num(x: float) -> str:
+    """ Fixed-point number for Desmos, which doesn't accept exponent notation. """
+    return f'{x:.4f}'.rstrip('0').rstrip('.')
+
+
+_DESMOS_HEAD = '''
         <!DOCTYPE html>
         <script src="https://www.desmos.com/api/v1.7/calculator.js?apiKey=dcb31709b452b1cf9dc26972add0fda6"></script>
         <div id="calculator" style="width: 100%; height: 50vw;"></div>
         <script>
             var elt = document.getElementById('calculator');
             var calculator = Desmos.GraphingCalculator(elt, 
-                {{ expressions: {"true" if dev else "false"}, showGrid: false, showXAxis: false, showYAxis: false }});
+                {{ expressions: {dev}, showGrid: false, showXAxis: false, showYAxis: false }});
             calculator.setMathBounds({{ left: -200000, right: 200000, bottom: -100000, top: 100000 }});
             calculator.setExpressions(Array(
-                {expressions}
+                '''
+
+_DESMOS_TAIL = '''
             ));
           </script>
         '''
 
 
-# noinspection PyDeprecation
-def find(kmp, bounds=(None, None), verbose=False):
-    ckpt = kmp['CKPT']['entries']
-    ckph = kmp['CKPH']['entries']
-    numcps = len(ckpt)
-    grp = 0
+def find(kmp, bounds=(None, None), verbose=False, engine='lp'):
+    """
+    Finds ghost checkpoints, returned as a list of checkpoint indices, or (index, witness point) pairs if verbose.
+
+    :param engine: 'lp' solves each region with scipy's linprog, 'clip' clips all regions against the bounds box at once
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown GCP engine: {engine}')
+    cps, mats, consts = _gcp_systems(kmp)
+    feasible, witness = _feasible(mats, consts, bounds, engine)
+
     gcplist = []
+    for n, i in enumerate(cps):
+        # Each (prev, next) pair has two regions, one on either side of the checkpoint line
+        for side in range(2):
+            if feasible[n, side]:
+                gcplist += [(i, witness[n, side])] if verbose else [i]
+                break
+    return gcplist
+
+
+class GCPBaseline:
+    """
+    GCP results of an analyzed KMP, stored per checkpoint under a key made of its own quad and the quads of its
+    neighbours, which are everything its inequality systems depend on. Checkpoints keep their key when others
+    are inserted or removed around them, so results carry over even when indices shift.
+    """
+
+    def __init__(self, keys: list[bytes], gcplist: list, bounds):
+        self.bounds = tuple(bounds)
+        self.gcps = list(gcplist)
+        self.keys = keys
+        counts = Counter(gcplist)
+        self.results = {k: counts[i] for i, k in enumerate(keys)}
+
+    @classmethod
+    def from_kmp(cls, kmp, gcplist: list, bounds=(None, None)):
+        return cls(_cp_keys(checkpoint_graph(kmp)), gcplist, bounds)
+
+
+@dataclass
+class GCPUpdate:
+    gcps: list[int]             # Same as find's output for the new KMP
+    appeared: list[int]         # New GCPs not matching any baseline GCP, by key or by index
+    disappeared: list[int]      # Baseline GCPs not matching any new GCP, by key or by index
+    recomputed: int             # Number of checkpoints that had to be solved
+    baseline: GCPBaseline       # Results for the new KMP, to pass as the baseline of the next update
+
+
+def find_incremental(kmp, baseline: Optional[GCPBaseline], bounds=(None, None), engine='clip') -> GCPUpdate:
+    """
+    Finds ghost checkpoints like find, but reuses the baseline's result for every checkpoint whose own quad and
+    neighbouring quads are unchanged, and only solves the rest. A baseline found with different bounds is ignored.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown GCP engine: {engine}')
+    cpg = checkpoint_graph(kmp)
+    keys = _cp_keys(cpg)
+    if baseline is not None and baseline.bounds != tuple(bounds):
+        baseline = None
+    known = baseline.results if baseline is not None else {}
+
+    counts = [known.get(k, 0) for k in keys]
+    todo = [i for i, k in enumerate(keys) if k not in known]
+    if todo:
+        cps, mats, consts = _gcp_systems(cpg, todo)
+        feasible, _ = _feasible(mats, consts, bounds, engine)
+        for i, f in zip(cps, feasible.any(axis=1)):
+            counts[i] += int(f)
+    gcplist = [i for i in range(cpg.cp_count) for _ in range(counts[i])]
+
+    appeared = []
+    disappeared = []
+    if baseline is not None:
+        old_keys = {baseline.keys[i] for i in baseline.gcps}
+        new_keys = {keys[i] for i in gcplist}
+        appeared = {i for i in gcplist if keys[i] not in old_keys}
+        disappeared = {i for i in baseline.gcps if baseline.keys[i] not in new_keys}
+        # A checkpoint edited in place that stays a GCP has neither appeared nor disappeared
+        appeared, disappeared = sorted(appeared - disappeared), sorted(disappeared - appeared)
+    return GCPUpdate(gcplist, appeared, disappeared, len(todo), GCPBaseline(keys, gcplist, bounds))
+
+
+def _cp_keys(cpg: CheckpointGraph) -> list[bytes]:
+    """ Key of each checkpoint's inequality systems: its quad, then its next and previous quads in order. """
+    quads = numpy.hstack((cpg.p1, cpg.p2))
+    keys = []
+    for i in range(cpg.cp_count):
+        nexts = cpg.nexts(i)
+        prevs = cpg.prevs(i)
+        keys.append(bytes([len(nexts), len(prevs)]) + quads[[i] + nexts + prevs].tobytes())
+    return keys
+
+
+def _gcp_systems(kmp, only=None):
+    """
+    Builds the two 7-inequality systems A x <= b, one per side of the checkpoint line, for every
+    (previous, next) checkpoint pair. Returns the checkpoint of each pair and the stacked systems.
+
+    :param only: Checkpoint indices to build systems for, defaults to all of them
+    """
+    cpg = checkpoint_graph(kmp)
+    numcps = cpg.cp_count
+    p1 = cpg.p1.tolist()
+    p2 = cpg.p2.tolist()
+    cps = []
+    mats = []
+    consts = []
 
     a_ = []
     b_ = []
@@ -158,31 +433,20 @@ def find(kmp, bounds=(None, None), verbose=False):
     d_ = []
     s1 = []
     s0 = []
-    prevs = []
-    nexts = []
+    prevs = [cpg.prevs(i) for i in range(numcps)]
+    nexts = [cpg.nexts(i) for i in range(numcps)]
     cpline = []
 
     for i in range(numcps):
-        a_.append(ckpt[i]["p1"][0])
-        b_.append(ckpt[i]["p1"][1] * -1)
-        c_.append(ckpt[i]["p2"][0])
-        d_.append(ckpt[i]["p2"][1] * -1)
+        a_.append(p1[i][0])
+        b_.append(p1[i][1] * -1)
+        c_.append(p2[i][0])
+        d_.append(p2[i][1] * -1)
         s1.append((a_[i] - c_[i]) / (((a_[i] - c_[i]) ** 2 + (d_[i] - b_[i]) ** 2) ** 0.5 or sys.float_info.min))
         s0.append((d_[i] - b_[i]) / (((a_[i] - c_[i]) ** 2 + (d_[i] - b_[i]) ** 2) ** 0.5 or sys.float_info.min))
         cpline.append([s0[i], s1[i], (s0[i] * -c_[i]) + (s1[i] * -d_[i])])
 
-        if ckpt[i]['prev'] == 255:
-            prevs += [[ckph[j]['start'] + ckph[j]['len'] - 1 for j in ckph[grp]['prev'] if j != 255]]
-        else:
-            prevs += [[i - 1]]
-
-        if ckpt[i]['next'] == 255:
-            nexts += [[ckph[j]['start'] for j in ckph[grp]['next'] if j != 255]]
-            grp += 1
-        else:
-            nexts += [[i + 1]]
-
-    for i in range(numcps):
+    for i in (range(numcps) if only is None else only):
         fbdr1 = []
         fbdr2 = []
         rbdr1 = []
@@ -216,7 +480,6 @@ def find(kmp, bounds=(None, None), verbose=False):
 
         for j in range(len(nexts[i])):
             for k in range(len(prevs[i])):
-                target = numpy.array([0, 0])
                 mat1 = numpy.array([
                     [fbdr1[j][0], fbdr1[j][1]],
                     [rbdr1[k][0], rbdr1[k][1]],
@@ -255,18 +518,124 @@ def find(kmp, bounds=(None, None), verbose=False):
                     vback[k][2]
                 ])
 
-                res1 = linprog(target, A_ub=mat1, b_ub=const1, bounds=bounds, method='highs')
-                res2 = linprog(target, A_ub=mat2, b_ub=const2, bounds=bounds, method='highs')
+                cps.append(i)
+                mats.append([mat1, mat2])
+                consts.append([const1, const2])
 
-                if res1.success:
-                    if verbose:
-                        gcplist += [(i, res1.x)]
-                    else:
-                        gcplist += [i]
-                elif res2.success:
-                    if verbose:
-                        gcplist += [(i, res2.x)]
-                    else:
-                        gcplist += [i]
+    return cps, numpy.array(mats, float).reshape(-1, 2, 7, 2), numpy.array(consts, float).reshape(-1, 2, 7)
 
-    return gcplist
+
+def _feasible(mats, consts, bounds, engine):
+    if engine == 'clip':
+        return _feasible_clip(mats, consts, bounds)
+    return _feasible_lp(mats, consts, bounds)
+
+
+# noinspection PyDeprecation
+def _feasible_lp(mats, consts, bounds):
+    target = numpy.array([0, 0])
+    feasible = numpy.zeros(consts.shape[:2], bool)
+    witness = numpy.zeros(consts.shape[:2] + (2,))
+    for n in range(len(mats)):
+        for side in range(2):
+            res = optimize.linprog(target, A_ub=mats[n, side], b_ub=consts[n, side], bounds=bounds, method='highs')
+            if res.success:
+                feasible[n, side] = True
+                witness[n, side] = res.x
+                break
+    return feasible, witness
+
+
+def _feasible_clip(mats, consts, bounds, tol=CLIP_TOLERANCE):
+    """
+    Tests every system at once by clipping the bounds box against its half-planes. A system is feasible if any of
+    the polygon survives, and the average of its remaining vertices is returned as the witness point.
+    """
+    shape = consts.shape[:2]
+    poly, nverts = clip_halfplanes(mats.reshape(-1, 7, 2), consts.reshape(-1, 7), bounds, tol)
+    valid = numpy.arange(poly.shape[1]) < nverts[:, None]
+    witness = (poly * valid[..., None]).sum(axis=1) / numpy.maximum(nverts, 1)[:, None]
+    return (nverts > 0).reshape(shape), witness.reshape(shape + (2,))
+
+
+def clip_halfplanes(mats, consts, bounds, tol=0.0):
+    """
+    Intersects the bounds box with each system of half-planes mats[n] . x <= consts[n], clipping against one
+    half-plane at a time (Sutherland-Hodgman, vectorized over systems).
+
+    :return: Polygon vertices padded to a fixed size, and the number of valid vertices of each (0 if empty)
+    """
+    count, nplanes = consts.shape
+    size = 4 + nplanes  # Box corners plus at most one new vertex per half-plane
+
+    # Normalize so the tolerance is a distance; empty rows (0 <= b) don't clip anything but may rule the system out
+    norm = numpy.hypot(mats[..., 0], mats[..., 1])
+    empty = norm == 0
+    infeasible = numpy.any(empty & (consts < -tol), axis=1)
+    norm[empty] = 1
+    normals = mats / norm[..., None]
+    offsets = numpy.where(empty, numpy.inf, consts / norm)
+
+    lo = -CLIP_UNBOUNDED if bounds[0] is None else bounds[0]
+    hi = CLIP_UNBOUNDED if bounds[1] is None else bounds[1]
+    poly = numpy.zeros((count, size, 2))
+    poly[:, :4] = [(lo, lo), (hi, lo), (hi, hi), (lo, hi)]
+    nverts = numpy.where(infeasible, 0, 4)
+
+    for c in range(nplanes):
+        poly, nverts = _clip(poly, nverts, normals[:, c], offsets[:, c] + tol)
+    return poly, nverts
+
+
+def _clip(poly, nverts, normal, offset):
+    """ Clips each convex polygon to its half-plane normal . x <= offset. """
+    count, size = poly.shape[:2]
+    idx = numpy.arange(size)
+    valid = idx < nverts[:, None]
+    dist = numpy.einsum('nkd,nd->nk', poly, normal) - offset[:, None]
+    inside = (dist <= 0) & valid
+
+    # Following vertex of each edge, wrapping around at each polygon's own vertex count
+    follow = numpy.where(idx + 1 < nverts[:, None], idx + 1, 0)
+    poly_f = numpy.take_along_axis(poly, follow[..., None], axis=1)
+    dist_f = numpy.take_along_axis(dist, follow, axis=1)
+    inside_f = numpy.take_along_axis(inside, follow, axis=1)
+    crossing = valid & (inside != inside_f)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t = numpy.where(crossing, dist / (dist - dist_f), 0)
+    cross_pts = poly + t[..., None] * (poly_f - poly)
+
+    # Each edge emits its start vertex if inside, then the crossing point if it crosses; compact emitted points
+    cand = numpy.stack([poly, cross_pts], axis=2).reshape(count, 2 * size, 2)
+    keep = numpy.stack([inside, crossing], axis=2).reshape(count, 2 * size)
+    order = numpy.argsort(~keep, axis=1, kind='stable')[:, :size]
+    return numpy.take_along_axis(cand, order[..., None], axis=1), numpy.minimum(keep.sum(axis=1), size)
+
+
+if __name__ == '__main__':
+    # Differential check of both engines over every track in the CTGP folder, at the bounds \gcps uses
+    import os
+    import time
+    from core import paths
+    from utils import kmpreader
+
+    bounds = (-500000, 500000)
+    elapsed = {eng: 0.0 for eng in ENGINES}
+    mismatches = 0
+    tracks = [t for t in sorted(os.listdir(paths.CTGP)) if not t.startswith('_')]
+    for track in tracks:
+        with open(paths.CTGP / track / 'course.kmp', 'rb') as f:
+            cpgraph = CheckpointGraph(kmpreader.parse(f, engine='numpy', lazy=True))
+        results = {}
+        for eng in ENGINES:
+            start = time.perf_counter()
+            results[eng] = find(cpgraph, bounds=bounds, engine=eng)
+            elapsed[eng] += time.perf_counter() - start
+        if len(set(map(tuple, results.values()))) > 1:
+            mismatches += 1
+            print(f'MISMATCH {track}: ' + ', '.join(f'{eng}={gcps}' for eng, gcps in results.items()))
+
+    print(f'{len(tracks)} tracks, {mismatches} mismatches')
+    for eng, t in elapsed.items():
+        print(f'{eng:>5}: {t:.3f}s total, {t / max(len(tracks), 1) * 1000:.2f}ms per track')
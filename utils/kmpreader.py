@@ -1,19 +1,88 @@
+import collections.abc
+
+import numpy
 from construct import *
 
 
-def parse(file):
-    kmpobj = kmp_format.parse(file.read())
+SECTIONS = ('KTPT', 'ENPT', 'ENPH', 'ITPT', 'ITPH', 'CKPT', 'CKPH', 'GOBJ',
+            'POTI', 'AREA', 'CAME', 'JGPT', 'CNPT', 'MSPT', 'STGI')
+ENGINES = ('construct', 'numpy')
+
+
+def parse(file, engine='construct', lazy=False):
+    """
+    Parses a KMP file into a dict of sections, each with 'entrycount', 'data' and 'entries'.
+
+    :param file: Binary file object positioned at the start of the KMP
+    :param engine: 'construct' returns entries as lists of Containers, 'numpy' returns them as structured arrays
+    :param lazy: Return a LazyKMP that only decodes a section when it is first accessed
+    """
+    if lazy:
+        return LazyKMP(file.read(), engine)
+    if engine == 'numpy':
+        kmpobj = parse_numpy(file.read())
+    elif engine == 'construct':
+        kmpobj = kmp_format.parse(file.read())
+    else:
+        raise ValueError(f'Unknown KMP engine: {engine}')
     compute_ckph_layers(kmpobj, 0, 1)
     return dict(kmpobj)
 
 
+class LazyKMP(collections.abc.Mapping):
+    """ Read-only KMP mapping that parses the header up front and decodes each section on first access. """
+
+    def __init__(self, data: bytes, engine='construct'):
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown KMP engine: {engine}')
+        self._data = data
+        self._engine = engine
+        self._header = parse_header(data)
+        self._sections = {}
+
+    def __getitem__(self, key):
+        if key in self._header:
+            return self._header[key]
+        if key not in SECTIONS:
+            raise KeyError(key)
+        if key not in self._sections:
+            self._sections[key] = self._decode(key)
+        return self._sections[key]
+
+    def __iter__(self):
+        yield from self._header
+        yield from SECTIONS
+
+    def __len__(self):
+        return len(self._header) + len(SECTIONS)
+
+    def _decode(self, name: str):
+        offset = self._header['headerlen'] + self._header[f'{name}_offset']
+        if self._engine == 'numpy':
+            section = parse_section_numpy(self._data, offset, name)
+        else:
+            section = section_formats[name].parse(self._data[offset:])
+        if name == 'CKPH':
+            compute_ckph_layers({'CKPH': section}, 0, 1)
+        return section
+
+
 def compute_ckph_layers(kmp, group: int, layer: int):
     ckph = kmp['CKPH']['entries']
     ckph[group]['layer'] = layer
-    if len(ckph) > 1:
-        for i in ckph[group]['next']:
+    if len(ckph) <= 1:
+        return
+    # Depth-first with an explicit stack, so long group chains can't hit the recursion limit
+    stack = [(group, iter(ckph[group]['next']))]
+    while stack:
+        g, children = stack[-1]
+        for i in children:
             if i != 255 and ckph[i]['layer'] == -1:
-                compute_ckph_layers(kmp, i, layer + 1)
+                ckph[i]['layer'] = ckph[g]['layer'] + 1
+                stack.append((i, iter(ckph[i]['next'])))
+                break
+        else:
+            stack.pop()
 
 
 ktpt_format = Struct(
@@ -251,6 +320,24 @@ stgi_format = Struct(
     )[this.entrycount]
 )
 
+section_formats = {
+    'KTPT': ktpt_format,
+    'ENPT': enpt_format,
+    'ENPH': enph_format,
+    'ITPT': itpt_format,
+    'ITPH': itph_format,
+    'CKPT': ckpt_format,
+    'CKPH': ckph_format,
+    'GOBJ': gobj_format,
+    'POTI': poti_format,
+    'AREA': area_format,
+    'CAME': came_format,
+    'JGPT': jgpt_format,
+    'CNPT': cnpt_format,
+    'MSPT': mspt_format,
+    'STGI': stgi_format,
+}
+
 kmp_format = Struct(
     'magic' / Const(b'RKMD'),
     'len' / Int,
@@ -288,3 +375,170 @@ kmp_format = Struct(
     'MSPT' / Pointer(this.headerlen + this.MSPT_offset, mspt_format),
     'STGI' / Pointer(this.headerlen + this.STGI_offset, stgi_format)
 )
+
+
+# NUMPY ENGINE #########################################################################################################
+
+
+def _be_dtype(*fields):
+    """ Builds a packed big-endian dtype. Fields named None are skipped as padding of the given byte length. """
+    names, formats, offsets = [], [], []
+    pos = 0
+    for name, fmt in fields:
+        if name is None:
+            pos += fmt
+            continue
+        dt = numpy.dtype(fmt)
+        names.append(name)
+        formats.append(dt)
+        offsets.append(pos)
+        pos += dt.itemsize
+    return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': pos})
+
+
+def _native_dtype(raw: numpy.dtype, index='idx', extra=()):
+    """ Widens a raw section dtype to native int32/float64 fields with a leading index, like the construct engine. """
+    fields = [(index, 'i4')]
+    for name in raw.names:
+        sub = raw.fields[name][0]
+        base, shape = sub.base, sub.shape
+        fields.append((name, 'f8' if base.kind == 'f' else 'i4', shape))
+    return numpy.dtype(fields + list(extra))
+
+
+_header_dtype = _be_dtype(
+    ('magic', 'S4'),
+    ('len', '>u4'),
+    ('sectioncount', '>u2'),
+    ('headerlen', '>u2'),
+    ('ver', '>u4'),
+    *((f'{name}_offset', '>u4') for name in SECTIONS)
+)
+
+_section_header_dtype = _be_dtype(('name', 'S4'), ('entrycount', '>u2'), ('data', '>u2'))
+
+_path_dtype = _be_dtype(('start', 'u1'), ('len', 'u1'), ('prev', '6u1'), ('next', '6u1'), (None, 2))
+
+section_dtypes = {
+    'KTPT': _be_dtype(('pos', '3>f4'), ('rot', '3>f4'), ('playerID', '>u2'), (None, 2)),
+    'ENPT': _be_dtype(('pos', '3>f4'), ('variance', '>f4'), ('s1', '>u2'), ('s2', 'u1'), ('s3', 'u1')),
+    'ENPH': _path_dtype,
+    'ITPT': _be_dtype(('pos', '3>f4'), ('variance', '>f4'), ('s1', '>u2'), ('s2', '>u2')),
+    'ITPH': _path_dtype,
+    'CKPT': _be_dtype(('p1', '2>f4'), ('p2', '2>f4'), ('res', 'u1'), ('type', 'u1'), ('prev', 'u1'), ('next', 'u1')),
+    'CKPH': _path_dtype,
+    'GOBJ': _be_dtype(('id', '>u2'), ('xpf_id', '>u2'), ('pos', '3>f4'), ('rot', '3>f4'), ('scale', '3>f4'),
+                      ('route', '>u2'), ('settings', '8>u2'), ('presence', '>u2')),
+    'AREA': _be_dtype(('shape', 'u1'), ('type', 'u1'), ('camera', 'u1'), ('priority', 'u1'), ('pos', '3>f4'),
+                      ('rot', '3>f4'), ('scale', '3>f4'), ('s1', '>u2'), ('s2', '>u2'), ('route', 'u1'),
+                      ('enpt', 'u1'), (None, 2)),
+    'CAME': _be_dtype(('type', 'u1'), ('next', 'u1'), ('shake', 'u1'), ('route', 'u1'), ('pointspd', '>u2'),
+                      ('zoomspd', '>u2'), ('viewspd', '>u2'), ('start', 'u1'), ('movie', 'u1'), ('pos', '3>f4'),
+                      ('rot', '3>f4'), ('zoom_s', '>f4'), ('zoom_f', '>f4'), ('viewpos_s', '3>f4'),
+                      ('viewpos_f', '3>f4'), ('time', '>f4')),
+    'JGPT': _be_dtype(('pos', '3>f4'), ('rot', '3>f4'), ('id', '>u2'), ('range', '>u2')),
+    'CNPT': _be_dtype(('pos', '3>f4'), ('rot', '3>f4'), ('id', '>u2'), ('effect', '>u2')),
+    'MSPT': _be_dtype(('pos', '3>f4'), ('rot', '3>f4'), ('id', '>u2'), (None, 2)),
+    'STGI': _be_dtype(('laps', 'u1'), ('pole_pos', 'u1'), ('narrow', 'u1'), ('lensflare', 'u1'), (None, 1),
+                      ('flare_color', '4u1'), (None, 1), ('speedmod', '>f2')),
+}
+
+_poti_route_dtype = _be_dtype(('len', '>u2'), ('smooth', 'u1'), ('motion_type', 'u1'))
+_poti_point_dtype = _be_dtype(('pos', '3>f4'), ('s1', '>u2'), ('s2', '>u2'))
+
+native_dtypes = {name: _native_dtype(dt, 'idx') for name, dt in section_dtypes.items()}
+native_dtypes['ENPH'] = _native_dtype(_path_dtype, 'gidx')
+native_dtypes['ITPH'] = _native_dtype(_path_dtype, 'gidx')
+native_dtypes['CKPH'] = _native_dtype(_path_dtype, 'gidx', [('layer', 'i4')])
+_native_poti_point_dtype = _native_dtype(_poti_point_dtype)
+
+
+def _to_native(raw: numpy.ndarray, dtype: numpy.dtype) -> numpy.ndarray:
+    out = numpy.zeros(len(raw), dtype)
+    out[dtype.names[0]] = numpy.arange(len(raw))
+    for name in raw.dtype.names:
+        out[name] = raw[name]
+    return out
+
+
+def parse_header(data: bytes) -> dict:
+    """ Decodes the 0x4C byte KMP header and section offset table. """
+    header = numpy.frombuffer(data, _header_dtype, count=1)[0]
+    if header['magic'] != b'RKMD':
+        raise ValueError('File not recognized as KMP')
+    return {name: header[name].item() for name in _header_dtype.names}
+
+
+def parse_numpy(data: bytes) -> dict:
+    """ Decodes a KMP straight from the file buffer into NumPy structured arrays. """
+    header = parse_header(data)
+    kmpobj = dict(header)
+    for name in SECTIONS:
+        kmpobj[name] = parse_section_numpy(data, header['headerlen'] + header[f'{name}_offset'], name)
+    return kmpobj
+
+
+def parse_section_numpy(data: bytes, offset: int, name: str) -> dict:
+    sect = numpy.frombuffer(data, _section_header_dtype, count=1, offset=offset)[0]
+    if sect['name'] != name.encode('ascii'):
+        raise ValueError(f'Expected {name} section at offset {offset:#x}')
+    count = int(sect['entrycount'])
+    offset += _section_header_dtype.itemsize
+
+    if name == 'POTI':
+        entries, offsets = _parse_poti_numpy(data, offset, count)
+        return {'name': sect['name'], 'entrycount': count, 'data': int(sect['data']),
+                'entries': entries, 'offsets': offsets}
+
+    raw = numpy.frombuffer(data, section_dtypes[name], count=count, offset=offset)
+    entries = _to_native(raw, native_dtypes[name])
+    if name == 'CKPH':
+        entries['layer'] = -1
+    return {'name': sect['name'], 'entrycount': count, 'data': int(sect['data']), 'entries': entries}
+
+
+def _parse_poti_numpy(data: bytes, offset: int, count: int):
+    """ POTI routes have variable length, so walk the route headers once to build an offsets table first. """
+    offsets = numpy.zeros(count, 'i8')
+    lengths = numpy.zeros(count, 'i8')
+    for i in range(count):
+        offsets[i] = offset
+        lengths[i] = int.from_bytes(data[offset:offset + 2], 'big')
+        offset += _poti_route_dtype.itemsize + lengths[i] * _poti_point_dtype.itemsize
+
+    entries = []
+    for i in range(count):
+        head = numpy.frombuffer(data, _poti_route_dtype, count=1, offset=offsets[i])[0]
+        points_offset = offsets[i] + _poti_route_dtype.itemsize
+        raw = numpy.frombuffer(data, _poti_point_dtype, count=lengths[i], offset=points_offset)
+        entries.append({
+            'idx': i,
+            'len': int(head['len']),
+            'smooth': int(head['smooth']),
+            'motion_type': int(head['motion_type']),
+            'points': _to_native(raw, _native_poti_point_dtype),
+        })
+    return entries, offsets
+
+
+if __name__ == '__main__':
+    # Benchmark both engines over every track in the CTGP folder
+    import os
+    import time
+    from io import BytesIO
+    from core import paths
+
+    kmps = []
+    for track in sorted(os.listdir(paths.CTGP)):
+        kmp_path = paths.CTGP / track / 'course.kmp'
+        if not track.startswith('_') and os.path.isfile(kmp_path):
+            with open(kmp_path, 'rb') as f:
+                kmps.append(f.read())
+
+    for eng in ENGINES:
+        start = time.perf_counter()
+        for raw_kmp in kmps:
+            parse(BytesIO(raw_kmp), engine=eng)
+        elapsed = time.perf_counter() - start
+        per_track = elapsed / max(len(kmps), 1) * 1000
+        print(f'{eng:>10}: {elapsed:.3f}s total, {per_track:.2f}ms per track ({len(kmps)} tracks)')
@@ -0,0 +1,72 @@
+import importlib
+from types import ModuleType
+
+
+class LazyModule:
+    """
+    Stands in for a module until one of its attributes is first used, and only imports it then. Safe to use from
+    several threads, since the import itself goes through the import system's per-module locks.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def load(self) -> ModuleType:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        return f'<lazy module {self._name!r}{" (loaded)" if self.loaded else ""}>'
+
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
+
+
+def warm_up(*modules: LazyModule):
+    """ Imports modules ahead of their first use, meant to be run in a background thread. """
+    for module in modules:
+        module.load()
+
+
+if __name__ == '__main__':
+    # Import time and memory each module adds to a cold start, each imported alone in a fresh interpreter
+    import sys
+    import subprocess
+
+    modules = sys.argv[1:] or [
+        'numpy', 'discord', 'gspread', 'oauth2client.service_account', 'dropbox', 'requests', 'construct', 'oead',
+        'scipy.optimize', 'api.spreadsheet', 'api.dropbox_client', 'api.chadsoft', 'utils.kmpreader',
+        'utils.szsreader', 'utils.gcpfinder', 'core.tracklists', 'core.kmpcache', 'core.batchscan', 'bot',
+    ]
+    probe = (
+        'import sys, resource\n'
+        'before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+        '__import__(sys.argv[1])\n'
+        'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)\n'
+    )
+
+    print(f'{"module":>30} {"self ms":>9} {"total ms":>9} {"RSS KiB":>9}')
+    for name in modules:
+        res = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe, name], capture_output=True, text=True)
+        if res.returncode != 0:
+            print(f'{name:>30}  failed: {res.stderr.strip().splitlines()[-1]}')
+            continue
+        # -X importtime lines look like "import time: self [us] | cumulative | imported package"
+        times = {}
+        for line in res.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                self_us, total_us, imported = line[len('import time:'):].split('|')
+                if self_us.strip().isdigit():
+                    times[imported.strip()] = (int(self_us), int(total_us))
+        self_us, total_us = times.get(name, (0, 0))
+        print(f'{name:>30} {self_us / 1000:9.1f} {total_us / 1000:9.1f} {int(res.stdout.split()[-1]):9d}')
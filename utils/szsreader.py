@@ -12,24 +12,15 @@ def decompress(file) -> bytes:
 
 
 def extract_file(path: str, filename: str):
+    """ Returns the contents of the first archive member with the given name or path, or None if missing. """
     with open(path, 'rb') as f:
-        data = decompress(f)
+        return extract_member(f, filename)
 
-    header = U8Header.parse(data[0:])
-    if header.magic != 0x55AA382D:
-        raise ValueError('File not recognized as U8 archive')
 
-    root = U8Node.parse(data[header.first_offset:])
-    strings_offset = header.first_offset + root.end * U8Node.length()
-
-    for i in range(1, root.end):
-        offset = header.first_offset + i * U8Node.length()
-        node = U8Node.parse(data[offset:])
-        if not node.is_directory:
-            name_offset = node.name_offset + strings_offset
-            name = _parse_c_string(data[name_offset:])
-            if name == filename:
-                return data[node.start:(node.start + node.end)]
+def extract_member(file, filename: str):
+    """ Extracts a single archive member from an open SZS file. Returns None if the member is missing. """
+    member = SZSArchive.open(file).get(filename)
+    return bytes(member) if member is not None else None
 
 
 def extract_file_to(srcpath: str, dstpath: str, filename: str):
@@ -38,6 +29,80 @@ def extract_file_to(srcpath: str, dstpath: str, filename: str):
         f.write(data)
 
 
+class SZSArchive:
+    """
+    Decompressed U8 archive indexed by member path, decompressed and scanned only once.
+
+    Members are served as memoryview slices of the decompressed data, so reading them doesn't copy.
+    """
+
+    def __init__(self, data: bytes):
+        self._data = memoryview(data)
+        self._files: dict[str, tuple[int, int]] = {}
+        self._by_name: dict[str, tuple[int, int]] = {}
+        self._dirs: list[str] = []
+        self._build_index(data)
+
+    @classmethod
+    def open(cls, file):
+        return cls(decompress(file))
+
+    def _build_index(self, data: bytes):
+        header = U8Header.parse(data)
+        if header.magic != 0x55AA382D:
+            raise ValueError('File not recognized as U8 archive')
+
+        view = memoryview(data)
+        root = U8Node.parse(view[header.first_offset:])
+        strings_offset = header.first_offset + root.end * U8Node.length()
+        strings = _StringTable(view[strings_offset:header.first_offset + header.size])
+
+        # Stack of (index past last child, path) for each directory containing the current node
+        parents = [(root.end, '')]
+        nodes = view[header.first_offset + U8Node.length():strings_offset]
+        for i, node in enumerate(U8Node.iter_parse(nodes), 1):
+            while i >= parents[-1][0]:
+                parents.pop()
+            name = strings[node.name_offset]
+            path = f'{parents[-1][1]}/{name}' if parents[-1][1] else name
+            if node.is_directory:
+                parents.append((node.end, path))
+                self._dirs.append(path)
+            else:
+                self._files[path] = (node.start, node.end)
+                self._by_name.setdefault(name, (node.start, node.end))
+
+    def _locate(self, name: str):
+        if name in self._files:
+            return self._files[name]
+        if f'./{name}' in self._files:
+            return self._files[f'./{name}']
+        return self._by_name.get(name)
+
+    def __contains__(self, name: str):
+        return self._locate(name) is not None
+
+    def __getitem__(self, name: str) -> memoryview:
+        loc = self._locate(name)
+        if loc is None:
+            raise KeyError(name)
+        start, size = loc
+        return self._data[start:start + size]
+
+    def get(self, name: str, default=None):
+        return self[name] if name in self else default
+
+    def files(self) -> list[str]:
+        return list(self._files.keys())
+
+    def dirs(self) -> list[str]:
+        return list(self._dirs)
+
+    def extract_to(self, name: str, dstpath):
+        with open(dstpath, 'wb') as f:
+            f.write(self[name])
+
+
 @dataclass
 class U8Header:
     _FORMAT = BYTEORDER_FCHAR + 'I3i16x'
@@ -76,9 +141,67 @@ class U8Node:
         ls[1] = int.from_bytes(ls[1], byteorder='big', signed=False)
         return U8Node(*ls)
 
+    @classmethod
+    def iter_parse(cls, table):
+        """ Decodes a whole node table in one pass, without slicing the data per node. """
+        for is_directory, name_offset, start, end in struct.iter_unpack(cls._FORMAT, table):
+            yield U8Node(is_directory, int.from_bytes(name_offset, byteorder='big', signed=False), start, end)
+
+
+class _StringTable:
+    """ U8 string table split once into names keyed by their byte offset. """
+
+    def __init__(self, data):
+        self._data = data
+        self._names = {}
+        pos = 0
+        for raw in bytes(data).split(b'\0'):
+            self._names[pos] = str(raw, 'ascii')
+            pos += len(raw) + 1
+
+    def __getitem__(self, offset: int) -> str:
+        if offset in self._names:
+            return self._names[offset]
+        return _parse_c_string(self._data[offset:])     # Offset into the middle of another name
+
 
 def _parse_c_string(data: bytes) -> str:
     for i, b in enumerate(data):
         if b == 0:
             return str(data[:i], 'ascii')
     raise TypeError('C string missing null terminator')
+
+
+if __name__ == '__main__':
+    # Benchmark indexing every track's SZS against the old per-node slicing scan
+    import os
+    import time
+    from core import paths
+
+    def slicing_scan(data: bytes):
+        header = U8Header.parse(data[0:])
+        root = U8Node.parse(data[header.first_offset:])
+        strings_offset = header.first_offset + root.end * U8Node.length()
+        for i in range(1, root.end):
+            node = U8Node.parse(data[header.first_offset + i * U8Node.length():])
+            if not node.is_directory:
+                _parse_c_string(data[node.name_offset + strings_offset:])
+
+    archives = []
+    for track in sorted(os.listdir(paths.CTGP)):
+        if track.startswith('_'):
+            continue
+        for file in os.listdir(paths.CTGP / track):
+            if file.endswith('.szs'):
+                with open(paths.CTGP / track / file, 'rb') as f:
+                    archives.append(decompress(f))
+    archives.sort(key=len, reverse=True)
+    archives = archives[:20]
+    print(f'{len(archives)} largest archives, {sum(len(a) for a in archives) / 1e6:.1f} MB decompressed')
+
+    for label, scan in (('slicing', slicing_scan), ('iter_unpack', SZSArchive)):
+        start = time.perf_counter()
+        for archive in archives:
+            scan(archive)
+        elapsed = time.perf_counter() - start
+        print(f'{label:>12}: {elapsed * 1000:.2f}ms total, {elapsed / max(len(archives), 1) * 1000:.3f}ms per archive')